@@ -0,0 +1,205 @@
+"""
+Offline benchmark of rod_gen against synthetic corpora of growing size.
+
+For every corpus size it reports the time and peak RSS of compiling the model, the size of the
+model snapshot, the attempts per sentence from `rod_gen.exe --bench-attempts`, and throughput plus
+p50/p95/p99 latency of the resident worker and of spawning rod_gen.exe per sentence (the old way).
+It also records the ns/token table of `rod_gen.exe --bench-build`, which should stay flat as the
+corpus and its messages grow if building is linear, and with --corpus the attempts per sentence on
+a real corpus. Results are written as JSON so runs on different revisions can be compared.
+
+    dune build && python3 bench_rod_gen.py --sizes 10000,100000,1000000 --output bench.json \
+        --corpus text-files/all_messages_processed.txt
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from itertools import accumulate
+
+from generator import RodGenWorker
+
+DEFAULT_BINARY = "_build/default/rod_gen.exe"
+VOCAB_SIZE = 20_000
+
+
+def write_synthetic_corpus(path: str, n_messages: int, rng: random.Random) -> int:
+    """Writes n_messages lines of Zipf distributed words, returns the amount of tokens."""
+    words = [f"w{i}" for i in range(VOCAB_SIZE)]
+    cum_weights = list(accumulate(1 / rank for rank in range(1, VOCAB_SIZE + 1)))
+    n_tokens = 0
+    with open(path, 'w', encoding='utf-8') as f:
+        for _ in range(n_messages):
+            length = min(60, 1 + int(rng.expovariate(1 / 10)))
+            f.write(" ".join(rng.choices(words, cum_weights=cum_weights, k=length)) + "\n")
+            n_tokens += length
+    return n_tokens
+
+
+def run_with_rusage(command, cwd: str):
+    """Runs a command to completion, returns (wall seconds, peak RSS in KiB, stdout)."""
+    started = time.perf_counter()
+    process = subprocess.Popen(command, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout = process.stdout.read()
+    stderr = process.stderr.read()
+    _, status, usage = os.wait4(process.pid, 0)
+    seconds = time.perf_counter() - started
+    if os.waitstatus_to_exitcode(status) != 0:
+        raise RuntimeError(f"{' '.join(command)} failed:\n{stderr.decode()}")
+    return seconds, usage.ru_maxrss, stdout.decode()
+
+
+def percentiles(latencies: list) -> dict:
+    ordered = sorted(latencies)
+
+    def at(p):
+        return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)] * 1000
+
+    return {
+        "sentences_per_second": len(ordered) / sum(ordered),
+        "p50_ms": at(50),
+        "p95_ms": at(95),
+        "p99_ms": at(99),
+    }
+
+
+async def bench_worker(binary: str, cwd: str, n_sentences: int) -> dict:
+    """Latency of sentences served by one resident worker, after it has loaded the model."""
+    worker = RodGenWorker((binary, "--serve"), cwd=cwd)
+    started = time.perf_counter()
+    await worker.start()
+    startup_seconds = time.perf_counter() - started
+    latencies = []
+    try:
+        for _ in range(n_sentences):
+            started = time.perf_counter()
+            await worker.generate()
+            latencies.append(time.perf_counter() - started)
+    finally:
+        await worker.stop()
+    return {"startup_seconds": startup_seconds, **percentiles(latencies)}
+
+
+def bench_spawn(binary: str, cwd: str, n_sentences: int) -> dict:
+    """Latency of spawning rod_gen.exe for every sentence, model loading included."""
+    latencies = []
+    for _ in range(n_sentences):
+        started = time.perf_counter()
+        subprocess.run((binary,), cwd=cwd, check=True, stdout=subprocess.DEVNULL)
+        latencies.append(time.perf_counter() - started)
+    return percentiles(latencies)
+
+
+def bench_attempts(binary: str, cwd: str) -> dict:
+    _, _, output = run_with_rusage((binary, "--bench-attempts"), cwd)
+    match = re.search(r"([\d.]+) rejection, ([\d.]+) constrained, ([\d.]+) constrained without verbatim copies", output)
+    if not match:
+        return {}
+    return {
+        "rejection": float(match.group(1)),
+        "constrained": float(match.group(2)),
+        "constrained_without_verbatim_copies": float(match.group(3)),
+    }
+
+
+def bench_build(binary: str) -> list:
+    """The rows of `rod_gen.exe --bench-build`, build time per token for growing corpora and message lengths."""
+    with tempfile.TemporaryDirectory() as workdir:
+        _, _, output = run_with_rusage((binary, "--bench-build"), workdir)
+    rows = re.findall(r"(\d+) messages +(\d+) mean length +(\d+) tokens +([\d.]+) s +([\d.]+) ns/token", output)
+    return [
+        {"messages": int(messages), "mean_length": int(mean_length), "tokens": int(tokens),
+         "seconds": float(seconds), "ns_per_token": float(ns_per_token)}
+        for messages, mean_length, tokens, seconds, ns_per_token in rows
+    ]
+
+
+def bench_size(binary: str, n_messages: int, args, rng: random.Random) -> dict:
+    with tempfile.TemporaryDirectory() as workdir:
+        os.mkdir(os.path.join(workdir, "text-files"))
+        corpus = os.path.join(workdir, "text-files", "all_messages_processed.txt")
+        model = os.path.join(workdir, "text-files", "rod_model.bin")
+        n_tokens = write_synthetic_corpus(corpus, n_messages, rng)
+
+        build_seconds, build_peak_rss, _ = run_with_rusage((binary, "--compile"), workdir)
+        result = {
+            "messages": n_messages,
+            "tokens": n_tokens,
+            "build_seconds": build_seconds,
+            "build_peak_rss_kib": build_peak_rss,
+            "model_bytes": os.path.getsize(model),
+            "attempts_per_sentence": bench_attempts(binary, workdir),
+            "worker": asyncio.run(bench_worker(binary, workdir, args.sentences)),
+            "spawn_per_sentence": bench_spawn(binary, workdir, args.spawns),
+        }
+        print(
+            f"{n_messages:>9} messages: build {build_seconds:.2f}s, {build_peak_rss / 1024:.0f} MiB peak, "
+            f"worker p99 {result['worker']['p99_ms']:.2f}ms, spawn p50 {result['spawn_per_sentence']['p50_ms']:.0f}ms",
+            file=sys.stderr,
+        )
+        return result
+
+
+def bench_corpus_attempts(binary: str, corpus: str) -> dict:
+    """Attempts per sentence on a real corpus, which the synthetic ones only approximate."""
+    with tempfile.TemporaryDirectory() as workdir:
+        os.mkdir(os.path.join(workdir, "text-files"))
+        shutil.copyfile(corpus, os.path.join(workdir, "text-files", "all_messages_processed.txt"))
+        run_with_rusage((binary, "--compile"), workdir)
+        attempts = bench_attempts(binary, workdir)
+    print(f"{corpus}: {attempts} attempts per sentence", file=sys.stderr)
+    return {"corpus": corpus, "attempts_per_sentence": attempts}
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(("git", "rev-parse", "HEAD"), capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--binary", default=DEFAULT_BINARY, help="built rod_gen.exe")
+    parser.add_argument("--sizes", default="10000,100000,1000000", help="comma separated corpus sizes in messages")
+    parser.add_argument("--sentences", type=int, default=2000, help="sentences per size served by the worker")
+    parser.add_argument("--spawns", type=int, default=20, help="sentences per size generated by spawning rod_gen.exe")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--corpus", help="also report the attempts per sentence on this corpus, e.g. the bot's")
+    parser.add_argument("--skip-build-scaling", action="store_true", help="leave out the --bench-build table")
+    parser.add_argument("--output", help="write the results to this JSON file instead of stdout")
+    args = parser.parse_args()
+
+    binary = os.path.abspath(args.binary)
+    rng = random.Random(args.seed)
+    results = {
+        "revision": git_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "seed": args.seed,
+        "sizes": [bench_size(binary, int(size), args, rng) for size in args.sizes.split(",")],
+    }
+    if args.corpus:
+        results["corpus"] = bench_corpus_attempts(binary, args.corpus)
+    if not args.skip_build_scaling:
+        results["build_scaling"] = bench_build(binary)
+        for row in results["build_scaling"]:
+            print(f"{row['messages']:>9} messages, mean length {row['mean_length']:>5}: "
+                  f"{row['ns_per_token']:.1f} ns/token", file=sys.stderr)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
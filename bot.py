@@ -1,7 +1,11 @@
+import time
+BOOT_STARTED = time.monotonic() # first thing, so the time until the first /gen is served includes the imports
+
 import discord
 from discord.ext import commands, tasks
 from discord import app_commands
 import asyncio
+import collections
 import random
 import hashlib
 import json
@@ -9,6 +13,12 @@ import os
 import re
 from typing import Optional
 from dotenv import load_dotenv
+import grod_oracle
+from generator import RodGenClient, RodGenPool, RodGenError, SentencePool
+from leader_lease import LeaderLease
+from metrics import Counter, Gauge, Histogram, dump_metrics_periodically, serve_metrics
+from slot_machine import SLOT_COST_PER_SPIN, SLOT_PAYOUTS, expected_value, resolve_spin, spin
+from state_store import SharedCounter, StateStore
 from config_data import (
     TARGET_CHANNEL_IDS,    #IDs where generated rod quotes are posted
     FREQUENT_CHANNEL_ID,   #ID of the channel where generated rod quotes get posted once a minute
@@ -16,6 +26,10 @@ from config_data import (
     RULE_POST_CHANNEL_IDS, #ID of the channels where rod_rules are posted
     RULE_GIFS              #GIFs utilised in rod_rules
 )
+try:
+    from config_data import LEARN_AUTHOR_IDS # IDs of the users whose new messages the generator learns from
+except ImportError:
+    LEARN_AUTHOR_IDS = []                    # not set in older config files, learning stays off
 
 load_dotenv() #loading of the .env file, which is where the bot token is stored
 
@@ -24,46 +38,63 @@ if TOKEN is None:
     print("Error: DISCORD_BOT_TOKEN environment variable not set. Please check your .env file.")
     exit(1)
 
+# set both to run this process as one shard of several, e.g. BOT_SHARD_ID=0 BOT_SHARD_COUNT=2 and BOT_SHARD_ID=1 BOT_SHARD_COUNT=2
+SHARD_ID = os.getenv("BOT_SHARD_ID")
+SHARD_COUNT = os.getenv("BOT_SHARD_COUNT")
+if SHARD_ID or SHARD_COUNT:
+    if not (SHARD_ID and SHARD_COUNT and SHARD_ID.isdigit() and SHARD_COUNT.isdigit() and int(SHARD_ID) < int(SHARD_COUNT)):
+        print("Error: BOT_SHARD_ID and BOT_SHARD_COUNT have to be set together, to a shard ID below the shard count.")
+        exit(1)
+    # shards with their own workers would all append to the corpus, but only the leader checkpoints it
+    if not os.getenv("ROD_GEN_SOCKET"):
+        print("Error: shards have to share one generation service, start rod_gen_service.py and set ROD_GEN_SOCKET.")
+        exit(1)
+shard_options = {"shard_id": int(SHARD_ID), "shard_count": int(SHARD_COUNT)} if SHARD_COUNT else {}
+
 intents = discord.Intents.default()
 intents.message_content = True                                  # we want to see the content of messages (e.g. for rod_rules)
-bot = commands.Bot(command_prefix=["!", ":"], intents=intents)  # our prefixes are ! and :
+bot = commands.Bot(command_prefix=["!", ":"], intents=intents, **shard_options)  # our prefixes are ! and :
 
-dune_exec_lock = asyncio.Lock() # this is a 'lock', it ensures that certain procedures are used one at a time, e.g. you cant use a procedure before someone else is finished
 
-RULES_FILE = 'json-files/rules_data.json'                   # amount of made rules are stored here
+RULES_FILE = 'json-files/rules_data.json'                   # amount of made rules (and other bot state) are stored here
 CURRENT_FLEET_FILE = 'text-files/fleet-members.txt'         # fleet members of shirobobs-fleet are stored here
 FORMER_FLEET_FILE = 'text-files/former-fleet-members.txt'   # former fleet members are stored here
 
-def load_rule_number():
-    """Procedure to get the amount of existing rod_rules"""
-    if os.path.exists(RULES_FILE):
-        with open(RULES_FILE, 'r') as f:
-            data = json.load(f)
-            return data.get('last_rule_number', 0)
-    return 0
-
-def save_rule_number(number):
-    """Procedure to set the new amount of existing rod_rules."""
-    with open(RULES_FILE, 'w') as f:
-        json.dump({'last_rule_number': number}, f)
-
-current_rule_number = load_rule_number() # get the current rule nr
-
-
-SLOT_EMOJIS = ["🍒", "🔔", "⭐", "💎", "💰", "7️⃣", "BAR"]  # emojis used as options in our slot machine
-SLOT_WEIGHTS = [800, 150, 80, 40, 20, 10, 100]             # their weights, i.e. how likely are they to appear
-
-# the slot payouts, necessary for showing what you won and for the winnings command
-SLOT_PAYOUTS = { 
-    "7️⃣": 5000,
-    "💰": 1000,
-    "💎": 500,
-    "BAR": 75,
-    "⭐": 100,
-    "🔔": 50,
-    "🍒": 10
-}
-SLOT_COST_PER_SPIN = 5 # 'price' for a spin of the slot machine
+RULE_COUNTER_FILE = 'json-files/rule_counter.json'          # the rule counter shared by all bot processes
+LEADER_LOCK_FILE = 'json-files/leader.lock'                 # held by the process that drives the scheduled posts
+
+bot_state = StateStore(RULES_FILE) # kept in memory, written to disk in the background
+# shards and processes sharing a generation service each have their own bot_state, so they count rules
+# in a file they all lock instead, a single process counts in memory in bot_state. Either one carries
+# on from the highest number the other reached, so switching between the two never reuses a number
+MULTI_PROCESS = bool(SHARD_COUNT or os.getenv("ROD_GEN_SOCKET"))
+rule_counter = SharedCounter(RULE_COUNTER_FILE, 'last_rule_number', floor=bot_state.get('last_rule_number', 0))
+if not MULTI_PROCESS:
+    bot_state.data['last_rule_number'] = rule_counter.read()
+leader_lease = LeaderLease(LEADER_LOCK_FILE)
+
+
+ROD_GEN_WORKERS = int(os.getenv("ROD_GEN_WORKERS", min(4, os.cpu_count() or 1))) # amount of rod_gen processes generating messages side by side
+ROD_GEN_TIMEOUT = 10                          # seconds a single generation may take before its worker is restarted
+ROD_GEN_SOCKET = os.getenv("ROD_GEN_SOCKET")  # if set, generate through the rod_gen_service.py listening there instead
+LEADER_RETRY_SECONDS = 30                     # how often a process without the leader lease tries to take it over
+
+LEARNING_CHANNEL_IDS = {*TARGET_CHANNEL_IDS, FREQUENT_CHANNEL_ID, RULES_CHANNEL_ID, *RULE_POST_CHANNEL_IDS} # channels new messages are learned from
+
+FANOUT_CONCURRENCY = 5      # at most this many channels are posted to at the same time
+CHANNEL_RATE_LIMIT = (5, 5) # at most 5 posts per 5 seconds per channel, in line with Discord's channel limit
+
+SENTENCE_POOL_LOW_WATERMARK = 5   # the pool starts refilling once it holds this many generated messages or less
+SENTENCE_POOL_HIGH_WATERMARK = 30 # and stops once it holds this many
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108")) # local port serving /metrics and /metrics.json, 0 turns it off
+METRICS_JSON_FILE = os.getenv("METRICS_JSON_FILE")     # if set, the metrics are also written to this file every minute
+if SHARD_ID:
+    # shards on one host each serve and dump their own metrics, shard n on METRICS_PORT + n
+    METRICS_PORT = METRICS_PORT and METRICS_PORT + int(SHARD_ID)
+    if METRICS_JSON_FILE:
+        root, extension = os.path.splitext(METRICS_JSON_FILE)
+        METRICS_JSON_FILE = f"{root}.shard{SHARD_ID}{extension}"
 
 # decorations for showing the fleet members
 TOP_BANNER = "-------------------[ShiroBob's fleet]--------------------"
@@ -74,13 +105,60 @@ BOTTOM_BANNER = "---------------------------------------------------------"
 @bot.event
 async def on_ready():
     print(f"Logged in as {bot.user} (ID: {bot.user.id})")
+    asyncio.create_task(sync_command_tree())
+    await start_metrics()
+    sentence_pool.start()
+    if not claim_leadership.is_running():
+        claim_leadership.start()
+
+
+@tasks.loop(seconds=LEADER_RETRY_SECONDS)
+async def claim_leadership():
+    """
+    Starts the scheduled posts and checkpoints in the one process holding the leader lease, so running
+    several processes does not post twice. The others keep trying, to take over when the leader goes away.
+    """
+    if leader_lease.held or not leader_lease.try_acquire():
+        return
+    print("Acquired the leader lease, this process drives the scheduled posts")
+    send_rod_message.start()
+    send_frequent_rod_message.start()
+    checkpoint_learned_messages.start()
+
+
+async def setup_hook():
+    """Runs before the gateway connection is made, so the workers load the model while the bot logs in."""
+    asyncio.create_task(prewarm_rod_gen())
+
+bot.setup_hook = setup_hook
+
+def command_tree_hash() -> str:
+    """A hash of the registered application commands, it changes whenever a sync would change anything."""
+    commands_data = [command.to_dict(bot.tree) for command in bot.tree.get_commands()]
+    payload = json.dumps({"application_id": bot.application_id, "commands": commands_data}, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+async def sync_command_tree():
+    """Syncs the command tree with Discord, unless it has not changed since the last sync."""
+    tree_hash = command_tree_hash()
+    if bot_state.get('command_tree_hash') == tree_hash:
+        print("Commands unchanged since the last sync, skipping the sync")
+        return
     try:
         synced = await bot.tree.sync()
         print(f"Synced {len(synced)} command(s)")
+        bot_state.set('command_tree_hash', tree_hash)
     except Exception as e:
         print(f"Failed to sync commands: {e}")
-    send_rod_message.start()
-    send_frequent_rod_message.start()
+
+async def prewarm_rod_gen():
+    """Starts the rod_gen workers so the first generation does not have to wait for the model to load."""
+    started = time.monotonic()
+    try:
+        await rod_gen_pool.start()
+        print(f"rod_gen workers ready after {time.monotonic() - started:.2f}s")
+    except Exception as e:
+        print(f"Failed to prewarm rod_gen, workers start on first use instead: {type(e).__name__} - {e}")
 
 
 @bot.hybrid_command(name="gen", description="Generate a message like rod")
@@ -89,8 +167,12 @@ async def gen(ctx: commands.Context):
     Generates a message from rod's discord messages.
     """
     await ctx.defer()
-    output = await run_rod_gen()
+    try:
+        output = await generate_rod_message()
+    except Exception as e:
+        output = generation_error_message(e)
     await ctx.reply(output or "No output.")
+    record_first_gen()
 
     
 @bot.hybrid_command(name="invite", description="Join to get all the rod updates u could ever want or need!")
@@ -121,6 +203,22 @@ async def patreon_features(ctx: commands.Context):
     )
     await ctx.reply(output_message)
     
+async def resolve_referenced_message(reference: discord.MessageReference, channel) -> Optional[discord.Message]:
+    """
+    The message a reply points at, taken from the reply itself when Discord included it, else from
+    discord.py's message cache, and only fetched over REST as a last resort. None if it was deleted.
+    """
+    if isinstance(reference.resolved, discord.Message):
+        return reference.resolved
+    if isinstance(reference.resolved, discord.DeletedReferencedMessage):
+        return None
+    if reference.cached_message is not None:
+        return reference.cached_message
+    try:
+        return await channel.fetch_message(reference.message_id)
+    except discord.NotFound:
+        return None
+
 @bot.command(name="rod_rule", description="Create a new rod rule (or generate one if no text is given).")
 async def rod_rule(ctx: commands.Context, *, rule_text: Optional[str] = None):
     """
@@ -131,57 +229,33 @@ async def rod_rule(ctx: commands.Context, *, rule_text: Optional[str] = None):
     """
     await ctx.defer(ephemeral=True)
 
-    is_quoting = False
+    replied_message = None
     if ctx.message.reference:
-        is_quoting = True
         try:
-            replied_message = await ctx.channel.fetch_message(ctx.message.reference.message_id)
-            if replied_message.author.id == ctx.author.id:
-                await ctx.followup.send("'You cannot quote your own message, thats not how quotes work.' -rod", ephemeral=True)
-                return
-            if replied_message.content:
-                final_rule_text = replied_message.content
-                quoted_author_name = replied_message.author.display_name
-                quoted_author_avatar = replied_message.author.avatar.url if replied_message.author.avatar else None
-                generated = False
-            else:
-                await ctx.followup.send("I can't quote this messages content, and will provide my own.", ephemeral=True)
-                is_quoting = False
-        except discord.NotFound:
-            await ctx.followup.send("I can't find the replied message.", ephemeral=True)
-            is_quoting = False
+            replied_message = await resolve_referenced_message(ctx.message.reference, ctx.channel)
+            if replied_message is None:
+                await ctx.reply("I can't find the replied message.", ephemeral=True)
         except discord.HTTPException as e:
-            await ctx.followup.send(f"Error fetching replied message: {e}.", ephemeral=True)
-            is_quoting = False
-    if not is_quoting and ctx.channel.id != RULES_CHANNEL_ID:
-        await ctx.followup.send("Regular rod rules (non-quotes or generated) can only be created in Hephy's general.", ephemeral=True)
+            await ctx.reply(f"Error fetching replied message: {e}.", ephemeral=True)
+
+    quoted_message = None
+    if replied_message is not None:
+        if replied_message.author.id == ctx.author.id:
+            await ctx.reply("'You cannot quote your own message, thats not how quotes work.' -rod", ephemeral=True)
+            return
+        if replied_message.content:
+            quoted_message = replied_message
+        else:
+            await ctx.reply("I can't quote this messages content, and will provide my own.", ephemeral=True)
+
+    if quoted_message is None and ctx.channel.id != RULES_CHANNEL_ID:
+        await ctx.reply("Regular rod rules (non-quotes or generated) can only be created in Hephy's general.", ephemeral=True)
         return
 
-    final_rule_text = rule_text
-    quoted_author_name = None
-    quoted_author_avatar = None
+    final_rule_text = quoted_message.content if quoted_message else rule_text
     generated = False
-    
-    if ctx.message.reference:
-        try:
-            replied_message = await ctx.channel.fetch_message(ctx.message.reference.message_id)
-            if replied_message.author.id == ctx.author.id:
-                await ctx.followup.send("'You cannot quote your own message, thats not how quotes work.' -rod", ephemeral=True)
-                return
-            if replied_message.content:
-                final_rule_text = replied_message.content
-                quoted_author_name = replied_message.author.display_name
-                quoted_author_avatar = replied_message.author.avatar.url if replied_message.author.avatar else None
-                generated = False
-            else:
-                await ctx.followup.send("The replied message has no text content to quote.", ephemeral=True)
-        except discord.NotFound:
-            await ctx.followup.send("Could not find the replied message.", ephemeral=True)
-        except discord.HTTPException as e:
-            await ctx.followup.send(f"Error fetching replied message: {e}", ephemeral=True)
-
     if final_rule_text is None or not final_rule_text.strip():
-        generated_text = await run_rod_gen()
+        generated_text = await next_rod_message()
         if generated_text:
             final_rule_text = generated_text
             generated = True
@@ -189,41 +263,41 @@ async def rod_rule(ctx: commands.Context, *, rule_text: Optional[str] = None):
             await ctx.reply("Failed to generate a rule. Please try again or provide text directly.")
             return
 
-    global current_rule_number
-    current_rule_number += 1
-    save_rule_number(current_rule_number)
+    rule_number = await next_rule_number()
     embed = discord.Embed(
-        title=f"Rule {current_rule_number}: {final_rule_text}",
+        title=f"Rule {rule_number}: {final_rule_text}",
         color=0xF7DC6F,
     )
 
     selected_gif_url = random.choice(RULE_GIFS)
     embed.set_image(url=selected_gif_url)
 
-    if quoted_author_name:
-        embed.set_footer(text=f"Quoted from {quoted_author_name}", icon_url=quoted_author_avatar)
+    if quoted_message:
+        quoted_author = quoted_message.author
+        embed.set_footer(text=f"Quoted from {quoted_author.display_name}", icon_url=quoted_author.avatar.url if quoted_author.avatar else None)
     else:
         footer_source = " (Generated)" if generated else ""
         embed.set_footer(text=f"Submitted by {ctx.author.display_name}{footer_source}", icon_url=ctx.author.avatar.url)
 
-    await ctx.reply("New rod rule added!", ephemeral=True)
+    # the confirmation and the posts go out side by side
+    rule_channel_ids = [channel_id for channel_id in RULE_POST_CHANNEL_IDS if channel_id != ctx.channel.id]
+    _, failures = await asyncio.gather(
+        ctx.reply("New rod rule added!", ephemeral=True),
+        fan_out(rule_channel_ids, embed=embed),
+    )
+    for channel_id, e in failures.items():
+        if isinstance(e, discord.Forbidden):
+            print(f"Uhm, senile rod lacks permission to post rule embed in channel ID: {channel_id}")
+        elif not isinstance(e, LookupError):
+            print(f"Error posting rule embed to channel ID {channel_id}: {e}")
 
-    for channel_id in RULE_POST_CHANNEL_IDS:
-        if channel_id == ctx.channel.id:
-            continue
+    
+async def next_rule_number() -> int:
+    if MULTI_PROCESS:
+        return await rule_counter.increment()
+    return bot_state.increment('last_rule_number')
 
-        channel = bot.get_channel(channel_id)
-        if channel:
-            try:
-                await channel.send(embed=embed)
-            except discord.Forbidden:
-                print(f"Uhm, senile rod lacks permission to post rule embed in channel ID: {channel_id}")
-            except Exception as e:
-                print(f"Error posting rule embed to channel ID {channel_id}: {e}")
-        else:
-            pass
 
-    
 @bot.command(name="grod", description="Ask grod if something is real!")
 async def grod(ctx: commands.Context, *, question: str):
     """
@@ -233,23 +307,7 @@ async def grod(ctx: commands.Context, *, question: str):
     the question has to do with a 'white genocide' in South Africa. 
     (https://www.theguardian.com/technology/2025/may/14/elon-musk-grok-white-genocide)
     """
-    normalized_question = question.strip().lower()
-    seed = hash(normalized_question)
-
-    rng = random.Random(seed)
-    is_real = rng.choice([True, False])
-
-    if is_real:
-        affirmative_responses = ["yes", "ye", "yea", "yup", "real :white_check_mark:"]
-        response = rng.choice(affirmative_responses)
-    else:
-        negative_responses = ["no", "nuh-uh", "nahh", "not real :x:"]
-        response = rng.choice(negative_responses)
-
-    if rng.random() < 0.10:
-        response += " - but I'm not sure what this has to do with a white genocide in South Africa?"
-    
-    await ctx.reply(response)
+    await ctx.reply(grod_oracle.answer(question))
     
     
 
@@ -283,38 +341,9 @@ async def gamble(ctx: commands.Context):
     """
     This procedure simulates a slot machine, rod enterprises does not endorse gambling.
     """
-    results = random.choices(SLOT_EMOJIS, weights=SLOT_WEIGHTS, k=3)
-    reel1, reel2, reel3 = results[0], results[1], results[2]
-    slot_display = f"**[ {reel1} | {reel2} | {reel3} ]**"
-    
-    payout = 0
-    message = ""
-
-    if reel1 == reel2 == reel3:
-        payout = SLOT_PAYOUTS.get(reel1, 0)
-
-        if reel1 == "7️⃣":
-            message = f"**🎰 TRIPLE SEVEN JACKPOT! You won ${payout}!**"
-        elif reel1 == "💰":
-            message = f"**💸 MONEY BAG MADNESS! You won ${payout}!**"
-        elif reel1 == "💎":
-            message = f"**💎 DIAMOND DELIGHT! You won ${payout}! **"
-        elif reel1 == "⭐":
-            message = f"**⭐ STARBURST! You won ${payout}!**"
-        elif reel1 == "🔔":
-            message = f"**🔔 RING-A-DING-DING! You won ${payout}!**"
-        elif reel1 == "BAR":
-            message = f"**📊 BAR BONANZA! You won ${payout}!**"
-        else: # "🍒"
-            message = f"**🍒🍒🍒 Cherry Jackpot! You won ${payout}!**"
-    elif (reel1 == reel2 and reel1 != reel3) or \
-         (reel1 == reel3 and reel1 != reel2) or \
-         (reel2 == reel3 and reel2 != reel1):
-        payout = 0 
-        message = "**Almost! Try again!**"
-    else: 
-        payout = 0
-        message = "**Better luck next time! No wins this spin.**"
+    reels = spin()
+    slot_display = f"**[ {reels[0]} | {reels[1]} | {reels[2]} ]**"
+    _, message = resolve_spin(reels)
 
     await ctx.reply(f"{slot_display}\n\n{message}")
     
@@ -334,6 +363,9 @@ async def winnings(ctx: commands.Context):
         response_lines.append(f"[ {emoji} | {emoji} | {emoji} ] - **${payout}**")
 
     response_lines.append(f"\n*Cost per spin: ${SLOT_COST_PER_SPIN}*")
+    odds = expected_value()
+    response_lines.append(f"*Three of a kind once every {1 / odds['hit_frequency']:.1f} spins, "
+                          f"paying back {odds['rtp']:.1%} of what goes in on average*")
 
     await ctx.reply("\n".join(response_lines))
     
@@ -435,6 +467,76 @@ async def op_rps(ctx: commands.Context, choice: str):
         f"**{result_message}**"
     )
     
+def _read_text_file(path: str) -> str:
+    with open(path, 'r', encoding='utf-8') as f:
+        return f.read()
+
+def _count_fleet_members(current_members_content: str) -> int:
+    """
+    Counts the number of current fleet members.
+    """
+    num_members = 0
+    for line in current_members_content.splitlines():
+        stripped_line = line.strip()
+        if stripped_line and not stripped_line.startswith('-'):
+            num_members += 1
+    return num_members
+
+class FleetRoster:
+    """
+    Keeps the fleet roster files in memory, together with the rendered roster and the member count.
+    A file is only read again (off the event loop) once its modification time changed, and that is
+    checked at most once every `check_interval` seconds, so spamming the fleet commands stays in memory.
+    """
+
+    def __init__(self, current_file: str, former_file: str, check_interval: float = 5.0):
+        self.current_file = current_file
+        self.former_file = former_file
+        self.check_interval = check_interval
+        self._files = {}       # path -> (mtime, content)
+        self._checked_at = {}  # path -> when its mtime was last checked
+        self._rendered = None  # (current content, former content, response text)
+        self._counted = None   # (current content, member count)
+
+    async def _content(self, path: str) -> str:
+        cached = self._files.get(path)
+        now = time.monotonic()
+        if cached and now - self._checked_at[path] < self.check_interval:
+            return cached[1]
+        try:
+            mtime = (await asyncio.to_thread(os.stat, path)).st_mtime_ns
+        except FileNotFoundError:
+            self._files.pop(path, None)
+            raise
+        self._checked_at[path] = now
+        if not cached or cached[0] != mtime:
+            cached = (mtime, await asyncio.to_thread(_read_text_file, path))
+            self._files[path] = cached
+        return cached[1]
+
+    async def response_text(self) -> str:
+        current_members_content = await self._content(self.current_file)
+        former_members_content = await self._content(self.former_file)
+        if self._rendered is None or self._rendered[:2] != (current_members_content, former_members_content):
+            full_fleet_content = (
+                f"{TOP_BANNER}\n"
+                f"{current_members_content.strip()}\n"
+                f"{MID_BANNER}\n"
+                f"{former_members_content.strip()}\n"
+                f"{BOTTOM_BANNER}"
+            )
+            response_text = f"```\n{full_fleet_content}\n```"
+            self._rendered = (current_members_content, former_members_content, response_text)
+        return self._rendered[2]
+
+    async def member_count(self) -> int:
+        current_members_content = await self._content(self.current_file)
+        if self._counted is None or self._counted[0] != current_members_content:
+            self._counted = (current_members_content, _count_fleet_members(current_members_content))
+        return self._counted[1]
+
+fleet_roster = FleetRoster(CURRENT_FLEET_FILE, FORMER_FLEET_FILE)
+
 @bot.hybrid_command(name="shirobobs-fleet", description="Shows the current and former members of ShiroBob's fleet.")
 async def shirobobs_fleet(ctx: commands.Context):
     """
@@ -444,21 +546,7 @@ async def shirobobs_fleet(ctx: commands.Context):
         await ctx.interaction.response.defer()
 
     try:
-        with open(CURRENT_FLEET_FILE, 'r', encoding='utf-8') as f:
-            current_members_content = f.read()
-
-        with open(FORMER_FLEET_FILE, 'r', encoding='utf-8') as f:
-            former_members_content = f.read()
-
-        full_fleet_content = (
-            f"{TOP_BANNER}\n"
-            f"{current_members_content.strip()}\n"
-            f"{MID_BANNER}\n"
-            f"{former_members_content.strip()}\n"
-            f"{BOTTOM_BANNER}"
-        )
-
-        response_text = f"```\n{full_fleet_content}\n```"
+        response_text = await fleet_roster.response_text()
 
         if ctx.interaction:
             await ctx.interaction.followup.send(response_text)
@@ -479,24 +567,18 @@ async def shirobobs_fleet(ctx: commands.Context):
         else:
             await ctx.send(error_message)
         
-def _count_fleet_members() -> int:
+async def _current_fleet_size() -> int:
     """
-    Counts the number of current fleet members.
+    Gets the number of current fleet members from the roster cache.
     """
-    num_members = 0
     try:
-        with open(CURRENT_FLEET_FILE, 'r', encoding='utf-8') as f:
-            for line in f:
-                stripped_line = line.strip()
-                if stripped_line and not stripped_line.startswith('-'):
-                    num_members += 1
+        return await fleet_roster.member_count()
     except FileNotFoundError:
         print(f"Fleet members file not found at {CURRENT_FLEET_FILE}.")
         return 0
     except Exception as e:
         print(f"ERROR: An error occurred while counting fleet members: {e}")
         return 0
-    return num_members
     
 @bot.hybrid_command(name="crew_size", description="Reports the current number of members in ShiroBob's fleet.")
 async def crew_size(ctx: commands.Context):
@@ -507,7 +589,7 @@ async def crew_size(ctx: commands.Context):
         await ctx.interaction.response.defer()
 
     try:
-        num_members = _count_fleet_members()
+        num_members = await _current_fleet_size()
 
         response_message = f"ShiroBob's fleet currently has **{num_members}** members."
 
@@ -524,28 +606,87 @@ async def crew_size(ctx: commands.Context):
             await ctx.send(error_message)
     
    
+class RateBucket:
+    """
+    Allows `rate` sends per `per` seconds, a send over the limit waits for its turn
+    without holding up sends to other channels.
+    """
+
+    def __init__(self, rate: int, per: float):
+        self.rate = rate
+        self.per = per
+        self.sent_at = collections.deque()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while self.sent_at and time.monotonic() - self.sent_at[0] >= self.per:
+                self.sent_at.popleft()
+            if len(self.sent_at) >= self.rate:
+                await asyncio.sleep(self.per - (time.monotonic() - self.sent_at.popleft()))
+            self.sent_at.append(time.monotonic())
+
+channel_buckets = collections.defaultdict(lambda: RateBucket(*CHANNEL_RATE_LIMIT)) # channel ID -> its RateBucket
+channel_cache = {}                                                                 # channel ID -> channel object
+fanout_semaphore = asyncio.Semaphore(FANOUT_CONCURRENCY)
+
+def get_cached_channel(channel_id: int):
+    """bot.get_channel, remembered until the channel is deleted. On a shard, channels of other shards are sent to by ID."""
+    channel = channel_cache.get(channel_id)
+    if channel is None:
+        channel = bot.get_channel(channel_id)
+        if channel is None and SHARD_COUNT:
+            channel = bot.get_partial_messageable(channel_id) # the channel is in a guild of another shard
+        if channel is not None:
+            channel_cache[channel_id] = channel
+    return channel
+
+@bot.listen("on_guild_channel_delete")
+async def forget_deleted_channel(channel):
+    channel_cache.pop(channel.id, None)
+
+async def fan_out(channel_ids, **send_kwargs) -> dict:
+    """
+    Sends the same message to all given channels concurrently, FANOUT_CONCURRENCY at a time and within
+    each channel's rate bucket, so posting takes as long as the slowest channel instead of all of them.
+    A failing channel does not stop the others, the failures are returned as {channel ID: exception},
+    channels that cannot be found fail with a LookupError.
+    """
+    async def send(channel_id):
+        channel = get_cached_channel(channel_id)
+        if channel is None:
+            raise LookupError(f"channel {channel_id} not found")
+        await channel_buckets[channel_id].acquire()
+        async with fanout_semaphore:
+            await channel.send(**send_kwargs)
+
+    results = await asyncio.gather(*(send(channel_id) for channel_id in channel_ids), return_exceptions=True)
+    return {channel_id: result for channel_id, result in zip(channel_ids, results) if isinstance(result, Exception)}
+
 @tasks.loop(hours=1)
 async def send_rod_message():
-    output = await run_rod_gen()
+    record_loop_drift("send_rod_message", 3600)
+    output = await next_rod_message()
     if not output:
         print("No output generated for recurring message.")
         return
 
-    for channel_id in TARGET_CHANNEL_IDS:
-        channel = bot.get_channel(channel_id)
-        if channel:
-            await channel.send(output)
-        else:
+    failures = await fan_out(TARGET_CHANNEL_IDS, content=output)
+    for channel_id, e in failures.items():
+        if isinstance(e, LookupError):
             print(f"Target channel with ID {channel_id} not found.")
+        else:
+            print(f"Error sending recurring message to channel ID {channel_id}: {e}")
            
 @tasks.loop(seconds=60)
 async def send_frequent_rod_message():
-    output = await run_rod_gen()
+    record_loop_drift("send_frequent_rod_message", 60)
+    output = await next_rod_message()
     if not output:
         print("No output generated for frequent recurring message.")
         return
 
-    channel = bot.get_channel(FREQUENT_CHANNEL_ID)
+    channel = get_cached_channel(FREQUENT_CHANNEL_ID)
     if channel:
         try:
             await channel.send(output)
@@ -557,26 +698,133 @@ async def send_frequent_rod_message():
     else:
         print(f"Frequent target channel with ID {FREQUENT_CHANNEL_ID} not found or accessible.")
 
-async def run_rod_gen() -> str:
-    async with dune_exec_lock:
-        try:
-            process = await asyncio.create_subprocess_exec(
-                "dune", "exec", "./rod_gen.exe",
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            stdout, stderr = await process.communicate()
-            
-            response = stdout.decode().strip()
-            
-            if process.returncode != 0:
-                error_message = stderr.decode().strip()
-                return f"rod_gen.exe (dune exec) exited with code {process.returncode}:\n{error_message}"
-
-            return response
-        except FileNotFoundError:
-            return "Error: 'dune' or 'rod_gen.exe' not found. Ensure they are in your PATH or specify full paths."
-        except Exception as e:
-            return f"Error running rod_gen.exe: {type(e).__name__} - {str(e)}"
+if ROD_GEN_SOCKET:
+    rod_gen_pool = RodGenClient(ROD_GEN_SOCKET, timeout=ROD_GEN_TIMEOUT) # workers shared with the other bot processes
+else:
+    rod_gen_pool = RodGenPool(ROD_GEN_WORKERS, timeout=ROD_GEN_TIMEOUT) # resident rod_gen processes, each loads the model once
+
+async def generate_rod_messages(n: int) -> list:
+    """Generates n fresh messages in one request to a worker, raises instead of returning an error message."""
+    return await rod_gen_pool.generate(n)
+
+sentence_pool = SentencePool(
+    generate_rod_messages,
+    low_watermark=SENTENCE_POOL_LOW_WATERMARK,
+    high_watermark=SENTENCE_POOL_HIGH_WATERMARK,
+)
+
+def generation_error_message(e: Exception) -> str:
+    """What went wrong generating a message, for the /gen reply and the logs."""
+    if isinstance(e, FileNotFoundError):
+        return "Error: _build/default/rod_gen.exe not found. Run 'dune build' first."
+    if isinstance(e, RodGenError):
+        return str(e)
+    return f"Error running rod_gen.exe: {type(e).__name__} - {str(e)}"
+
+async def generate_rod_message() -> str:
+    """Pops a pre-generated message from the pool, only generating one live when the pool is empty. Raises if that fails."""
+    sentence = sentence_pool.pop()
+    SENTENCE_POOL_REQUESTS.inc(result="hit" if sentence else "miss")
+    return sentence or await rod_gen_pool.generate()
+
+async def next_rod_message() -> Optional[str]:
+    """Like generate_rod_message, but logs a failure and returns None, so an error never gets posted as a message."""
+    try:
+        return await generate_rod_message()
+    except Exception as e:
+        print(f"Could not generate a message: {generation_error_message(e)}")
+        return None
 
-bot.run(TOKEN) 
+def to_corpus_line(message: discord.Message) -> str:
+    """
+    Turns a message into a line of all_messages_processed.txt: mentions are written out by name,
+    with the spaces inside a name replaced by the \x1F placeholder so rod_gen keeps it as one token
+    (and prints it with spaces again), and all other whitespace becomes single spaces.
+    """
+    content = message.clean_content
+    mention_names = [f"@{user.display_name}" for user in message.mentions]
+    mention_names += [f"@{role.name}" for role in message.role_mentions]
+    for name in mention_names:
+        content = content.replace(name, name.replace(" ", "\x1F"))
+    return re.sub(r"[ \t\r\n]+", " ", content).strip()
+
+@bot.listen("on_message")
+async def learn_from_message(message: discord.Message):
+    """
+    Feeds new messages by LEARN_AUTHOR_IDS in the channels the bot posts in to the generator,
+    so its model keeps up without rebuilding it.
+    """
+    if message.author.bot or message.author.id not in LEARN_AUTHOR_IDS:
+        return
+    if message.channel.id not in LEARNING_CHANNEL_IDS or message.content.startswith(tuple(bot.command_prefix)):
+        return
+
+    line = to_corpus_line(message)
+    if not line:
+        return
+    try:
+        await rod_gen_pool.learn(line)
+    except (RodGenError, OSError) as e:
+        print(f"Could not add message {message.id} to the corpus: {e}")
+
+@tasks.loop(minutes=30)
+async def checkpoint_learned_messages():
+    """Recompiles the model snapshot with the messages learned since the last checkpoint."""
+    try:
+        await rod_gen_pool.checkpoint()
+    except (RodGenError, OSError) as e:
+        print(f"Failed to checkpoint learned messages: {e}")
+
+COMMAND_SECONDS = Histogram("bot_command_seconds", "Time from invoking a command to its reply, by command")
+COMMAND_FAILURES = Counter("bot_command_failures_total", "Commands that raised an error, by command")
+SENTENCE_POOL_REQUESTS = Counter("sentence_pool_requests_total", "Messages asked from the sentence pool, by hit or miss")
+LOOP_DRIFT = Gauge("bot_loop_drift_seconds", "How much later than its interval a background loop last ran, by loop")
+FIRST_GEN_SECONDS = Gauge("bot_time_to_first_gen_seconds", "Time from starting the bot to serving the first /gen")
+
+_last_loop_runs = {}
+_metrics_started = False
+
+@bot.before_invoke
+async def start_command_timer(ctx: commands.Context):
+    ctx.invoked_at = time.perf_counter()
+
+@bot.after_invoke
+async def record_command_metrics(ctx: commands.Context):
+    command = ctx.command.qualified_name
+    COMMAND_SECONDS.observe(time.perf_counter() - ctx.invoked_at, command=command)
+    if ctx.command_failed:
+        COMMAND_FAILURES.inc(command=command)
+
+def record_first_gen():
+    """Reports the time from startup to the first served /gen, once per run."""
+    if FIRST_GEN_SECONDS.values:
+        return
+    boot_seconds = time.monotonic() - BOOT_STARTED
+    FIRST_GEN_SECONDS.set(boot_seconds)
+    print(f"First /gen served {boot_seconds:.2f}s after startup")
+
+def record_loop_drift(name: str, interval: float):
+    """Records how much longer than `interval` seconds ago the loop `name` last ran."""
+    now = time.monotonic()
+    last_run = _last_loop_runs.get(name)
+    _last_loop_runs[name] = now
+    if last_run is not None:
+        LOOP_DRIFT.set(now - last_run - interval, loop=name)
+
+async def start_metrics():
+    """Starts the metrics endpoint and file dump once, on_ready can fire again after a reconnect."""
+    global _metrics_started
+    if _metrics_started:
+        return
+    _metrics_started = True
+    if METRICS_PORT:
+        try:
+            await serve_metrics(port=METRICS_PORT)
+            print(f"Serving metrics on http://127.0.0.1:{METRICS_PORT}/metrics")
+        except OSError as e:
+            print(f"Could not serve metrics on port {METRICS_PORT}: {e}")
+    if METRICS_JSON_FILE:
+        asyncio.create_task(dump_metrics_periodically(METRICS_JSON_FILE))
+
+bot.run(TOKEN)
+bot_state.flush_now() # write out whatever the background flush did not get to before shutdown
@@ -0,0 +1,545 @@
+import asyncio
+import json
+import os
+import time
+from typing import Optional
+
+from metrics import Counter, Histogram
+
+# rod_gen.exe in serve mode loads the corpus once and then answers one request per line. The built
+# binary is run directly, `dune build` (see senile-rod.sh) comes first, and concurrent `dune exec`
+# runs would all wait on dune's build lock
+ROD_GEN_BINARY = "./_build/default/rod_gen.exe"
+ROD_GEN_COMMAND = (ROD_GEN_BINARY, "--serve")
+ROD_GEN_COMPILE_COMMAND = (ROD_GEN_BINARY, "--compile")
+CORPUS_FILE = "text-files/all_messages_processed.txt"
+MODEL_FILE = "text-files/rod_model.bin" # the compiled snapshot the workers map
+STREAM_LIMIT = 1024 * 1024  # max size of a single response line
+STATS_INTERVAL = 60         # seconds between polls of the workers' generation counters
+COMPILE_TIMEOUT = 600       # seconds `rod_gen.exe --compile` may take before it is killed
+MAX_BATCH_SIZE = 1000       # most sentences a single `gen n` request may ask for, like rod_gen.exe's max_batch_size
+
+ROD_GEN_QUEUE_WAIT = Histogram("rod_gen_queue_wait_seconds", "Time spent waiting for an idle rod_gen worker")
+ROD_GEN_REQUEST_SECONDS = Histogram("rod_gen_request_seconds", "Time rod_gen took to answer a request, by request kind")
+ROD_GEN_FAILURES = Counter("rod_gen_failures_total", "Failed rod_gen requests, by reason")
+ROD_GEN_SENTENCES = Counter("rod_gen_sentences_total", "Sentences generated by the rod_gen workers")
+ROD_GEN_ATTEMPTS = Counter("rod_gen_attempts_total", "Generation attempts made by the rod_gen workers")
+ROD_GEN_GAVE_UP = Counter("rod_gen_gave_up_total", "Generations the rod_gen workers gave up on")
+ROD_GEN_REJECTED_VERBATIM = Counter("rod_gen_rejected_verbatim_total", "Sentences rejected for copying the corpus")
+
+
+class RodGenError(Exception):
+    """Raised when the rod_gen worker dies or answers with an error."""
+
+
+class RodGenWorker:
+    """
+    A resident rod_gen process speaking the line protocol of `rod_gen.exe --serve`.
+    The process is started lazily and restarted if it dies, requests are not safe to interleave,
+    so callers have to make sure only one request is in flight at a time.
+    """
+
+    def __init__(self, command=ROD_GEN_COMMAND, cwd: Optional[str] = None):
+        self.command = command
+        self.cwd = cwd  # rod_gen finds text-files/ relative to its working directory
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self.snapshot_seq = 0  # the model snapshot it has mapped, see RodGenPool
+        self.learned_seq = 0   # the last learned line it has been sent
+        self.stats = {}        # the counters of its last `stats` response, reset when it restarts
+
+    @property
+    def running(self) -> bool:
+        return self.process is not None and self.process.returncode is None
+
+    async def start(self):
+        """Starts the worker and waits until it has built its tables."""
+        self.stats = {}
+        self.process = await asyncio.create_subprocess_exec(
+            *self.command,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            limit=STREAM_LIMIT,
+            cwd=self.cwd,
+        )
+        greeting = await self._read_line()
+        if greeting != "ready":
+            self.kill()
+            raise RodGenError(f"rod_gen.exe sent an unexpected greeting: {greeting}")
+
+    async def stop(self):
+        """Closes stdin so the worker exits on its own, and kills it if it does not."""
+        if not self.running:
+            return
+        self.process.stdin.close()
+        try:
+            await asyncio.wait_for(self.process.wait(), timeout=5)
+        except asyncio.TimeoutError:
+            self.process.kill()
+            await self.process.wait()
+
+    def kill(self):
+        """Kills the worker right away, e.g. when a request was abandoned halfway through."""
+        if self.running:
+            self.process.kill()
+        self.process = None
+
+    async def request(self, line: str) -> str:
+        """Sends one request line and returns the response line."""
+        if not self.running:
+            await self.start()
+        try:
+            self.process.stdin.write(line.encode() + b"\n")
+            await self.process.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # the worker died, reading its stdout below reports why
+        response = await self._read_line()
+        if response.startswith("error: "):
+            raise RodGenError(response)
+        return response
+
+    async def generate(self) -> str:
+        return await self.request("gen")
+
+    async def _read_line(self) -> str:
+        line = await self.process.stdout.readline()
+        if not line:
+            await self.process.wait()
+            error_message = (await self.process.stderr.read()).decode().strip()
+            self.process = None
+            raise RodGenError(f"rod_gen.exe exited unexpectedly:\n{error_message}")
+        return line.decode().rstrip("\n")
+
+
+class RodGenPool:
+    """
+    A fixed number of RodGenWorkers so several generations can run at once.
+    Idle workers are handed out first come, first served. A request that times out or is
+    cancelled kills its worker, since its response would end up answering the next request,
+    the worker is then restarted on its next use.
+
+    Learned messages are numbered: every line up to `snapshot_seq` is in the compiled model
+    snapshot, the ones after it are kept in `learned` and sent to each worker before its next request.
+    Lines learned while a checkpoint compiles are held back from the corpus file until it is done,
+    so learning never waits on a compile.
+    Before the first worker starts, a snapshot older than the corpus (or than rod_gen.exe) is
+    recompiled, so lines learned after the previous run's last checkpoint are not lost.
+
+    The workers' generation counters are polled every `stats_interval` seconds by a background
+    task, between requests, so they never add a round trip to a generation.
+    """
+
+    def __init__(self, size: int, timeout: float = 10, command=ROD_GEN_COMMAND,
+                 compile_command=ROD_GEN_COMPILE_COMMAND, corpus_file: str = CORPUS_FILE,
+                 model_file: str = MODEL_FILE, stats_interval: float = STATS_INTERVAL,
+                 compile_timeout: float = COMPILE_TIMEOUT):
+        if size < 1:
+            raise ValueError("a pool needs at least one worker")
+        self.timeout = timeout
+        self.compile_command = compile_command
+        self.corpus_file = corpus_file
+        self.model_file = model_file
+        self.stats_interval = stats_interval
+        self.compile_timeout = compile_timeout
+        self.workers = [RodGenWorker(command) for _ in range(size)]
+        self.idle: asyncio.Queue = asyncio.Queue()
+        for worker in self.workers:
+            self.idle.put_nowait(worker)
+        self.learned: list = []  # (seq, line) pairs that are not in the snapshot yet
+        self.learned_seq = 0
+        self.snapshot_seq = 0
+        self._unwritten: list = []  # (seq, line) pairs not appended to the corpus file yet
+        self._written_seq = 0       # the last line appended to the corpus file
+        self._checkpointing = False
+        self._corpus_lock = asyncio.Lock()
+        self._snapshot_checked = False
+        self._stats_task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        """
+        Starts the idle workers that are not running yet side by side, so the model is loaded before
+        the first request instead of during it. Raises the first startup error, if any.
+        """
+        workers = []
+        while not self.idle.empty():
+            workers.append(self.idle.get_nowait())
+
+        async def start_worker(worker: RodGenWorker):
+            try:
+                if not worker.running:
+                    await self._start_worker(worker)
+            finally:
+                self.idle.put_nowait(worker)
+
+        results = await asyncio.gather(*(start_worker(worker) for worker in workers), return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
+    async def request(self, line: str) -> str:
+        waiting_since = time.perf_counter()
+        worker = await self.idle.get()
+        ROD_GEN_QUEUE_WAIT.observe(time.perf_counter() - waiting_since)
+        try:
+            if not worker.running:
+                await self._start_worker(worker)
+            with ROD_GEN_REQUEST_SECONDS.time(kind=_request_kind(line)):
+                return await asyncio.wait_for(self._request_up_to_date(worker, line), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            worker.kill()
+            ROD_GEN_FAILURES.inc(reason="timeout")
+            raise RodGenError(f"rod_gen.exe did not answer within {self.timeout} seconds.")
+        except RodGenError:
+            ROD_GEN_FAILURES.inc(reason="error")
+            raise
+        except asyncio.CancelledError:
+            worker.kill()
+            raise
+        finally:
+            self.idle.put_nowait(worker)
+
+    async def _start_worker(self, worker: RodGenWorker):
+        """Starts a worker under the same timeout as a request, one that hangs while loading is killed."""
+        if not self._snapshot_checked:
+            await self._compile_if_stale()
+        # taken before starting, a checkpoint finishing meanwhile may trim lines the worker's
+        # older snapshot lacks, a worker that did map the newer one just reloads it once more
+        snapshot_seq = self.snapshot_seq
+        try:
+            await asyncio.wait_for(worker.start(), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            worker.kill()
+            raise RodGenError(f"rod_gen.exe did not start within {self.timeout} seconds.")
+        except asyncio.CancelledError:
+            worker.kill()
+            raise
+        worker.snapshot_seq = worker.learned_seq = snapshot_seq
+        if self._stats_task is None:
+            self._stats_task = asyncio.create_task(self._poll_stats())
+
+    async def _request_up_to_date(self, worker: RodGenWorker, line: str) -> str:
+        """Brings the worker up to date with the snapshot and the learned lines before the request."""
+        if worker.snapshot_seq != self.snapshot_seq:
+            await worker.request("reload")
+            worker.snapshot_seq = worker.learned_seq = self.snapshot_seq
+        for seq, learned_line in self.learned:
+            if seq > worker.learned_seq:
+                await worker.request(f"learn {learned_line}")
+                worker.learned_seq = seq
+        return await worker.request(line)
+
+    async def _poll_stats(self):
+        while True:
+            await asyncio.sleep(self.stats_interval)
+            await self.collect_stats()
+
+    async def collect_stats(self):
+        """
+        Adds what the counters of the idle, running workers grew by since their last poll to the
+        metrics. Workers busy with a request are left alone and picked up by the next poll.
+        """
+        for _ in range(self.idle.qsize()):
+            try:
+                worker = self.idle.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            try:
+                if worker.running:
+                    await asyncio.wait_for(self._record_stats(worker), timeout=self.timeout)
+            except asyncio.TimeoutError:
+                worker.kill()
+                ROD_GEN_FAILURES.inc(reason="timeout")
+            except (RodGenError, ValueError, KeyError) as e:
+                print(f"Could not collect rod_gen stats: {type(e).__name__} - {e}")
+            except asyncio.CancelledError:
+                worker.kill()
+                raise
+            finally:
+                self.idle.put_nowait(worker)
+
+    @staticmethod
+    async def _record_stats(worker: RodGenWorker):
+        """Adds what the worker's counters grew by since its last `stats` response to the metrics."""
+        stats = json.loads(await worker.request("stats"))
+        for name, counter in (("sentences", ROD_GEN_SENTENCES), ("attempts", ROD_GEN_ATTEMPTS),
+                              ("gave_up", ROD_GEN_GAVE_UP), ("rejected_verbatim", ROD_GEN_REJECTED_VERBATIM)):
+            counter.inc(stats[name] - worker.stats.get(name, 0))
+        worker.stats = stats
+
+    async def generate(self, n: Optional[int] = None, seed: Optional[int] = None):
+        """
+        Generates one sentence, or a list of n sentences in a single request when n is given.
+        A seed makes the batch reproducible.
+        """
+        if n is None:
+            return await self.request("gen")
+        _check_batch_size(n)
+        request = f"gen {n}" if seed is None else f"gen {n} {seed}"
+        return json.loads(await self.request(request))
+
+    async def learn(self, line: str):
+        """
+        Appends a corpus line to the corpus file, workers count it in before their next request.
+        A line whose append fails is still learned, it is appended along with the next one.
+        """
+        if "\n" in line:
+            raise ValueError("a corpus line cannot contain newlines")
+        self.learned_seq += 1
+        self.learned.append((self.learned_seq, line))
+        self._unwritten.append((self.learned_seq, line))
+        if not self._checkpointing:
+            await self._write_unwritten()
+
+    async def _write_unwritten(self):
+        """Appends the held back lines to the corpus file, in the order they were learned."""
+        async with self._corpus_lock:
+            lines, self._unwritten = self._unwritten, []
+            if not lines:
+                return
+            try:
+                await asyncio.to_thread(_append_lines, self.corpus_file, [line for _, line in lines])
+            except OSError:
+                self._unwritten = lines + self._unwritten
+                raise
+            self._written_seq = lines[-1][0]
+
+    async def checkpoint(self):
+        """
+        Recompiles the model snapshot from the corpus file in a separate process, so the workers keep
+        serving meanwhile, and has every worker map the new snapshot before its next request.
+        Lines learned during the compile are appended once it is done, so no line ends up both
+        compiled and replayed.
+        """
+        if self._checkpointing or not self.learned:
+            return
+        self._checkpointing = True
+        try:
+            await self._write_unwritten()
+            async with self._corpus_lock:
+                await self._compile()
+        finally:
+            self._checkpointing = False
+            await self._write_unwritten()
+
+    async def _compile_if_stale(self):
+        """Recompiles the snapshot if it is missing or older than the corpus or rod_gen.exe."""
+        async with self._corpus_lock:
+            if self._snapshot_checked:
+                return  # another worker's startup got here first
+            if _is_stale(self.model_file, self.corpus_file, self.compile_command[0]):
+                print(f"{self.model_file} is out of date, recompiling it")
+                try:
+                    await self._compile()
+                except (RodGenError, OSError) as e:
+                    print(f"Failed to recompile {self.model_file}, serving the old snapshot: {e}")
+            # only set once the compile is over, the other workers starting meanwhile wait on the lock
+            # instead of mapping the old snapshot
+            self._snapshot_checked = True
+
+    async def _compile(self):
+        """Runs the compile command and kills it after `compile_timeout` seconds, the caller holds the corpus lock."""
+        checkpoint_seq = self._written_seq
+        process = await asyncio.create_subprocess_exec(
+            *self.compile_command,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        try:
+            _, stderr = await asyncio.wait_for(process.communicate(), timeout=self.compile_timeout)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            raise RodGenError(f"rod_gen.exe --compile did not finish within {self.compile_timeout} seconds.")
+        except asyncio.CancelledError:
+            process.kill()
+            raise
+        if process.returncode != 0:
+            raise RodGenError(f"rod_gen.exe --compile exited with code {process.returncode}:\n{stderr.decode().strip()}")
+        self.snapshot_seq = checkpoint_seq
+        self.learned = [(seq, line) for seq, line in self.learned if seq > checkpoint_seq]
+
+    async def stop(self):
+        if self._stats_task is not None:
+            self._stats_task.cancel()
+            self._stats_task = None
+            await self.collect_stats()  # the counts since the last poll
+        await asyncio.gather(*(worker.stop() for worker in self.workers))
+
+
+class RodGenClient:
+    """
+    Talks to a rod_gen_service.py over its Unix socket, with the same interface as RodGenPool, so
+    several bot processes can share one set of workers and one learned corpus.
+    Connections are opened when needed and reused, with one request in flight per connection.
+    """
+
+    def __init__(self, socket_path: str, timeout: float = 10):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.idle: list = []  # (reader, writer) pairs of open connections
+
+    async def start(self):
+        """Checks that the service is up."""
+        await self.request("ping")
+
+    async def request(self, line: str, timeout: Optional[float] = None) -> str:
+        """Sends one request line and returns the response, waiting `timeout` seconds or the client's timeout."""
+        timeout = self.timeout if timeout is None else timeout
+        connection = self.idle.pop() if self.idle else None
+        try:
+            if connection is None:
+                connection = await asyncio.wait_for(
+                    asyncio.open_unix_connection(self.socket_path, limit=STREAM_LIMIT), timeout=self.timeout
+                )
+            with ROD_GEN_REQUEST_SECONDS.time(kind=_request_kind(line)):
+                response = await asyncio.wait_for(self._exchange(connection, line), timeout=timeout)
+        except asyncio.TimeoutError:
+            ROD_GEN_FAILURES.inc(reason="timeout")
+            self._close(connection)
+            raise RodGenError(f"the generation service did not answer within {timeout} seconds.")
+        except OSError as e:
+            ROD_GEN_FAILURES.inc(reason="error")
+            self._close(connection)
+            raise RodGenError(f"could not reach the generation service at {self.socket_path}: {e}")
+        except asyncio.CancelledError:
+            self._close(connection)
+            raise
+        if not response:
+            ROD_GEN_FAILURES.inc(reason="error")
+            self._close(connection)
+            raise RodGenError("the generation service closed the connection.")
+        self.idle.append(connection)
+        response = response.decode().rstrip("\n")
+        if response.startswith("error: "):
+            ROD_GEN_FAILURES.inc(reason="error")
+            raise RodGenError(response)
+        return response
+
+    @staticmethod
+    async def _exchange(connection, line: str) -> bytes:
+        reader, writer = connection
+        writer.write(line.encode() + b"\n")
+        await writer.drain()
+        return await reader.readline()
+
+    @staticmethod
+    def _close(connection):
+        if connection is not None:
+            connection[1].close()
+
+    async def generate(self, n: Optional[int] = None, seed: Optional[int] = None):
+        if n is None:
+            return await self.request("gen")
+        _check_batch_size(n)
+        request = f"gen {n}" if seed is None else f"gen {n} {seed}"
+        return json.loads(await self.request(request))
+
+    async def learn(self, line: str):
+        if "\n" in line:
+            raise ValueError("a corpus line cannot contain newlines")
+        await self.request(f"learn {line}")
+
+    async def checkpoint(self):
+        # the service answers once its compile is done, which is bounded by its own compile timeout
+        await self.request("checkpoint", timeout=COMPILE_TIMEOUT + self.timeout)
+
+    async def stop(self):
+        while self.idle:
+            self._close(self.idle.pop())
+
+
+def _request_kind(line: str) -> str:
+    """The metrics label of a request, batches get their own so they do not skew single /gen latencies."""
+    command, _, argument = line.partition(" ")
+    return "gen_batch" if command == "gen" and argument else command
+
+
+def _check_batch_size(n: int):
+    if not 0 <= n <= MAX_BATCH_SIZE:
+        raise ValueError(f"a batch has to hold between 0 and {MAX_BATCH_SIZE} sentences, got {n}")
+
+
+def _is_stale(model_file: str, *sources: str) -> bool:
+    """Whether the model file is missing or older than any of the source files that exist."""
+    if not os.path.exists(model_file):
+        return True
+    model_mtime = os.path.getmtime(model_file)
+    return any(os.path.exists(source) and os.path.getmtime(source) > model_mtime for source in sources)
+
+
+def _append_lines(filename: str, lines: list):
+    with open(filename, 'a', encoding='utf-8') as f:
+        f.writelines(line + "\n" for line in lines)
+
+
+class SentencePool:
+    """
+    A bounded queue of ready-made sentences for callers that should not wait on generation.
+    A background task refills the queue up to `high_watermark` whenever it drops to `low_watermark`,
+    in batches of at most `batch_size`. `generate` is an async callable taking a count and returning
+    that many sentences, raising if generation fails. A failed batch, or one of only empty sentences,
+    is retried after `retry_delay` seconds.
+    """
+
+    def __init__(self, generate, low_watermark: int = 5, high_watermark: int = 30, batch_size: int = 10,
+                 retry_delay: float = 10):
+        if not 0 <= low_watermark < high_watermark:
+            raise ValueError("low_watermark must be below high_watermark")
+        self.generate = generate
+        self.low_watermark = low_watermark
+        self.high_watermark = high_watermark
+        self.batch_size = batch_size
+        self.retry_delay = retry_delay
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=high_watermark)
+        self._refill = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        """Starts the producer task if it is not running yet and asks it to top up the pool."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._produce())
+        self._refill.set()
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def pop(self) -> Optional[str]:
+        """Returns a ready sentence, or None if the pool is empty."""
+        try:
+            sentence = self.queue.get_nowait()
+        except asyncio.QueueEmpty:
+            sentence = None
+        if self.queue.qsize() <= self.low_watermark:
+            self._refill.set()
+        return sentence
+
+    async def _produce(self):
+        while True:
+            await self._refill.wait()
+            self._refill.clear()
+            while not self.queue.full():
+                missing = self.high_watermark - self.queue.qsize()
+                try:
+                    sentences = await self.generate(min(missing, self.batch_size))
+                except Exception as e:
+                    print(f"Sentence pool could not generate sentences: {type(e).__name__} - {e}")
+                    await asyncio.sleep(self.retry_delay)
+                    self._refill.set()
+                    break
+                added = 0
+                for sentence in sentences:
+                    if sentence and not self.queue.full():
+                        self.queue.put_nowait(sentence)
+                        added += 1
+                if not added:
+                    # rod_gen gave up on the whole batch, asking again right away would keep a worker busy
+                    print("Sentence pool got no usable sentences, retrying later")
+                    await asyncio.sleep(self.retry_delay)
+                    self._refill.set()
+                    break
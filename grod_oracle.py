@@ -0,0 +1,73 @@
+"""
+Grod's answers, deterministic across restarts and processes.
+The answer to a question only depends on a SHA-256 digest of the normalized question, so every
+bot process (and every offline run) gives the same answer to the same question.
+
+    python3 grod_oracle.py questions.txt   # answers one question per line, as JSON
+"""
+import argparse
+import functools
+import hashlib
+import json
+import random
+import sys
+import time
+
+AFFIRMATIVE_RESPONSES = ["yes", "ye", "yea", "yup", "real :white_check_mark:"]
+NEGATIVE_RESPONSES = ["no", "nuh-uh", "nahh", "not real :x:"]
+CONFUSED_CHANCE = 0.10 # chance of grod wondering what the question has to do with a white genocide in South Africa
+CONFUSED_SUFFIX = " - but I'm not sure what this has to do with a white genocide in South Africa?"
+ANSWER_CACHE_SIZE = 4096 # answers to this many distinct questions are kept around
+
+
+def normalize_question(question: str) -> str:
+    return question.strip().lower()
+
+
+def question_seed(normalized_question: str) -> int:
+    """A seed that is the same in every process, unlike hash(), which Python salts per process."""
+    digest = hashlib.sha256(normalized_question.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big')
+
+
+@functools.lru_cache(maxsize=ANSWER_CACHE_SIZE)
+def _answer_normalized(normalized_question: str) -> str:
+    rng = random.Random(question_seed(normalized_question))
+    is_real = rng.choice([True, False])
+    response = rng.choice(AFFIRMATIVE_RESPONSES if is_real else NEGATIVE_RESPONSES)
+    if rng.random() < CONFUSED_CHANCE:
+        response += CONFUSED_SUFFIX
+    return response
+
+
+def answer(question: str) -> str:
+    """Grod's answer to a question, questions differing only in case or surrounding whitespace get the same one."""
+    return _answer_normalized(normalize_question(question))
+
+
+def answer_many(questions) -> list:
+    """Answers a batch of questions at once, in order."""
+    return [answer(question) for question in questions]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Answer questions the way the grod command does.")
+    parser.add_argument("questions", nargs="?", help="file with one question per line, stdin if left out")
+    args = parser.parse_args()
+
+    if args.questions:
+        with open(args.questions, 'r', encoding='utf-8') as f:
+            questions = f.read().splitlines()
+    else:
+        questions = sys.stdin.read().splitlines()
+
+    started = time.perf_counter()
+    answers = answer_many(questions)
+    seconds = time.perf_counter() - started
+    print(json.dumps(dict(zip(questions, answers)), indent=2, ensure_ascii=False))
+    print(f"answered {len(questions)} questions in {seconds * 1000:.2f}ms, cache: {_answer_normalized.cache_info()}",
+          file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+import fcntl
+
+
+class LeaderLease:
+    """
+    An exclusive flock on a lock file, held by at most one process at a time.
+    The kernel drops the lock when its holder exits or dies, so another process can take over by
+    calling `try_acquire` again, there is no expiry to renew.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = None
+
+    @property
+    def held(self) -> bool:
+        return self._file is not None
+
+    def try_acquire(self) -> bool:
+        """Takes the lease if no other process holds it, never blocks. Returns whether this process holds it."""
+        if self._file is not None:
+            return True
+        lock_file = open(self.path, 'a')
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return False
+        self._file = lock_file
+        return True
+
+    def release(self):
+        if self._file is not None:
+            self._file.close()  # closing the file drops the lock
+            self._file = None
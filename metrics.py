@@ -0,0 +1,167 @@
+"""
+A small in-process metrics registry with Prometheus text and JSON output.
+Metrics register themselves on creation, `serve_metrics` exposes them over HTTP on /metrics
+(Prometheus text format) and /metrics.json, `dump_metrics_periodically` writes the JSON to a file.
+"""
+import asyncio
+import bisect
+import json
+import os
+import time
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+REGISTRY = []
+
+
+def _label_key(labels: dict) -> tuple:
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key: tuple, extra: tuple = ()) -> str:
+    pairs = [*key, *extra]
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self.values = {}
+        REGISTRY.append(self)
+
+    def inc(self, amount: float = 1, **labels):
+        key = _label_key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield self.name, key, value
+
+    def to_json(self):
+        return [{"labels": dict(key), "value": value} for key, value in self.values.items()]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        self.values[_label_key(labels)] = value
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(buckets)
+        self.series = {}  # label key -> [bucket counts, sum, count]
+        REGISTRY.append(self)
+
+    def observe(self, value: float, **labels):
+        key = _label_key(labels)
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = [[0] * len(self.buckets), 0.0, 0]
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series[0][index] += 1
+        series[1] += value
+        series[2] += 1
+
+    def time(self, **labels):
+        """Context manager observing the time spent in its block."""
+        return _Timer(self, labels)
+
+    def samples(self):
+        for key, (bucket_counts, total, count) in self.series.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket", key + (("le", str(bound)),), cumulative
+            yield f"{self.name}_bucket", key + (("le", "+Inf"),), count
+            yield f"{self.name}_sum", key, total
+            yield f"{self.name}_count", key, count
+
+    def to_json(self):
+        return [
+            {"labels": dict(key), "buckets": dict(zip(map(str, self.buckets), bucket_counts)), "sum": total, "count": count}
+            for key, (bucket_counts, total, count) in self.series.items()
+        ]
+
+
+class _Timer:
+    def __init__(self, histogram: Histogram, labels: dict):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+
+
+def render_prometheus() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.description}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, key, value in metric.samples():
+            lines.append(f"{name}{_format_labels(key)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def render_json() -> dict:
+    return {"timestamp": time.time(), "metrics": {metric.name: metric.to_json() for metric in REGISTRY}}
+
+
+async def _handle_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass  # headers are not needed
+        parts = request_line.split()
+        path = parts[1].decode() if len(parts) > 1 else ""
+        if path == "/metrics":
+            status, content_type, body = "200 OK", "text/plain; version=0.0.4", render_prometheus()
+        elif path == "/metrics.json":
+            status, content_type, body = "200 OK", "application/json", json.dumps(render_json())
+        else:
+            status, content_type, body = "404 Not Found", "text/plain", "not found\n"
+        payload = body.encode()
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+            f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode() + payload
+        )
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+async def serve_metrics(host: str = "127.0.0.1", port: int = 9108) -> asyncio.AbstractServer:
+    """Starts the local metrics endpoint, returns the server so it can be closed again."""
+    return await asyncio.start_server(_handle_request, host, port)
+
+
+def _write_json(path: str, contents: str):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(contents)
+    os.replace(tmp_path, path)
+
+
+async def dump_metrics_periodically(path: str, interval: float = 60):
+    """Writes the metrics as JSON to `path` every `interval` seconds, forever."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await asyncio.to_thread(_write_json, path, json.dumps(render_json()))
+        except OSError as e:
+            print(f"Could not write metrics to {path}: {e}")
@@ -2,10 +2,6 @@ open Stdlib
 
 (* --- Text Processing Helpers --- *)
 
-let tokenize_line line =
-  String.split_on_char ' ' line
-  |> List.filter (fun word -> String.trim word <> "")
-
 let capitalize_string_first_char s =
   if s = "" then s
   else
@@ -21,61 +17,253 @@ let replace_placeholder_with_space s =
   ) s;
   Buffer.contents buffer
 
-(* --- List Helpers --- *)
+(* --- Tokenizer --- *)
 
-let list_slice (lst: 'a list) (start_index: int) (length: int) : 'a list =
-  let rec aux current_index acc = function
-    | [] -> List.rev acc
-    | h :: t ->
-      if current_index >= start_index && current_index < start_index + length then
-        aux (current_index + 1) (h :: acc) t
-      else if current_index >= start_index + length then
-        List.rev acc
-      else
-        aux (current_index + 1) acc t
+(* How corpus lines are normalised before they are split into tokens, every option merges tokens
+   that only differ in form. The compiled model records the normalisation it was built with, so
+   learned lines are tokenised the same way. Options that change what the bot writes are off by
+   default, `--stats` with an option shows what it would merge. *)
+type normalisation = {
+  lowercase : bool;          (* "Rod" and "rod" become one token *)
+  split_emoji : bool;        (* emoji stuck to a word, "lol😭", become a token of their own, and are
+                                then generated with a space before them, "lol 😭" *)
+  canonical_mentions : bool; (* nickname mentions <@!id> become <@id> *)
+  strip_url_queries : bool;  (* https://x.com/rod/status/1?s=20 becomes https://x.com/rod/status/1 *)
+}
+
+let default_normalisation = {
+  lowercase = false;
+  split_emoji = false;
+  canonical_mentions = true;
+  strip_url_queries = false;
+}
+
+let normalisation_flags (n: normalisation) : int =
+  (if n.lowercase then 1 else 0) lor (if n.split_emoji then 2 else 0)
+  lor (if n.canonical_mentions then 4 else 0) lor (if n.strip_url_queries then 8 else 0)
+
+let normalisation_of_flags (flags: int) : normalisation = {
+  lowercase = flags land 1 <> 0;
+  split_emoji = flags land 2 <> 0;
+  canonical_mentions = flags land 4 <> 0;
+  strip_url_queries = flags land 8 <> 0;
+}
+
+let nickname_mention = Str.regexp_string "<@!"
+let url_query = Str.regexp "\\(https?://[^ \t?#]*\\)[?#][^ \t]*"
+
+let normalise_line (n: normalisation) (line: string) : string =
+  let line = if n.canonical_mentions then Str.global_replace nickname_mention "<@" line else line in
+  let line = if n.strip_url_queries then Str.global_replace url_query "\\1" line else line in
+  if n.lowercase then String.lowercase_ascii line else line
+
+(* The code point starting at byte i and its length in bytes, a stray byte counts as one code point. *)
+let decode_utf_8 (s: string) (i: int) : int * int =
+  let b0 = Char.code s.[i] in
+  let length =
+    if b0 < 0x80 then 1
+    else if b0 land 0xE0 = 0xC0 then 2
+    else if b0 land 0xF0 = 0xE0 then 3
+    else if b0 land 0xF8 = 0xF0 then 4
+    else 1
   in
-  aux 0 [] lst
+  if length = 1 || i + length > String.length s then (b0, 1)
+  else
+    let rec add code_point k =
+      if k >= length then code_point else add ((code_point lsl 6) lor (Char.code s.[i + k] land 0x3F)) (k + 1)
+    in
+    (add (b0 land (0xFF lsr (length + 1))) 1, length)
+
+type char_class = Emoji | Joiner | Other
+
+let char_class (code_point: int) : char_class =
+  if code_point = 0x200D || code_point = 0xFE0F || code_point = 0x20E3 then Joiner (* ZWJ, emoji style, keycap *)
+  else if (code_point >= 0x1F000 && code_point <= 0x1FAFF) || (code_point >= 0x2600 && code_point <= 0x27BF) then Emoji
+  else Other
+
+(* Splits a token where it changes between emoji and other text. Joiners stay with what comes
+   before them, so "7️⃣" and emoji sequences like "👍🏻" stay whole. *)
+let split_emoji_runs (token: string) : string list =
+  let rec split i run_start run_class acc =
+    if i >= String.length token then List.rev (String.sub token run_start (i - run_start) :: acc)
+    else
+      let code_point, length = decode_utf_8 token i in
+      match char_class code_point, run_class with
+      | Joiner, _ -> split (i + length) run_start run_class acc
+      | current, previous when current = previous -> split (i + length) run_start run_class acc
+      | current, _ when i = run_start -> split (i + length) run_start current acc
+      | current, _ -> split (i + length) i current (String.sub token run_start (i - run_start) :: acc)
+  in
+  if String.length token = 0 then [] else split 0 0 Other []
+
+let is_whitespace (c: char) : bool =
+  c = ' ' || c = '\t' || c = '\n' || c = '\r' || c = '\x0B' || c = '\x0C'
+
+let split_on_whitespace (line: string) : string list =
+  let rec split i token_start acc =
+    if i >= String.length line || is_whitespace line.[i] then
+      let acc = if i > token_start then String.sub line token_start (i - token_start) :: acc else acc in
+      if i >= String.length line then List.rev acc else split (i + 1) (i + 1) acc
+    else split (i + 1) token_start acc
+  in
+  split 0 0 []
+
+let tokenize_line (n: normalisation) (line: string) : string list =
+  let tokens = split_on_whitespace (normalise_line n line) in
+  if n.split_emoji then List.concat_map split_emoji_runs tokens else tokens
+
+(* The interned vocabulary: every distinct token gets an int id once, and every model order
+   counts ids instead of keeping strings. *)
+type vocab = {
+  ids : (string, int) Hashtbl.t;
+  mutable words_rev : string list;
+  mutable size : int;
+}
+
+let intern (v: vocab) (word: string) : int =
+  match Hashtbl.find_opt v.ids word with
+  | Some id -> id
+  | None ->
+      let id = v.size in
+      Hashtbl.add v.ids word id;
+      v.words_rev <- word :: v.words_rev;
+      v.size <- id + 1;
+      id
+
+let create_vocab () : vocab =
+  let v = { ids = Hashtbl.create 100_000; words_rev = []; size = 0 } in
+  ignore (intern v "<START>");
+  ignore (intern v "<END>");
+  v
+
+let vocab_words (v: vocab) : string array = Array.of_list (List.rev v.words_rev)
+
+(* create_vocab interns these two first *)
+let start_id = 0
+let end_id = 1
 
 (* --- Markov Chain Core Logic --- *)
 
-type chain_key = string list
-type transition_table = (chain_key, string list) Hashtbl.t
+(* One trie serves every order up to the model's maximum. A node is a context read backwards,
+   starting at the word right before the next one, and its children extend that context one word
+   further back. Every node counts the followers of its context, so the node at depth d is the
+   order d state and all orders share the nodes of their common suffixes. *)
+type follower_counts = (int, int) Hashtbl.t (* every distinct follower id and how often it occurred *)
+type context_trie = {
+  children : (int, context_trie) Hashtbl.t; (* keyed by the id of the word one further back *)
+  followers : follower_counts;
+}
 
-let create_markov_table (order: int) (messages: string list list) : transition_table =
-  let table = Hashtbl.create 100_000 in
+let create_trie_node () : context_trie =
+  { children = Hashtbl.create 1; followers = Hashtbl.create 1 }
 
-  let add_transition key next_word =
-    Hashtbl.add table key (next_word :: (Hashtbl.find_opt table key |> Option.value ~default:[]))
+let add_message (trie: context_trie) (max_order: int) (ids: int array) : unit =
+  let child_of node id =
+    match Hashtbl.find_opt node.children id with
+    | Some child -> child
+    | None ->
+        let child = create_trie_node () in
+        Hashtbl.add node.children id child;
+        child
   in
 
-  let start_padding = List.init order (fun _ -> "<START>") in
-  let end_marker = "<END>" in
+  (* <START> padding, the message and <END> in one array, every context is a window over it *)
+  let padded_ids = Array.make (max_order + Array.length ids + 1) end_id in
+  Array.fill padded_ids 0 max_order start_id;
+  Array.blit ids 0 padded_ids max_order (Array.length ids);
+  for i = max_order to Array.length padded_ids - 1 do
+    let next_word = padded_ids.(i) in
+    let rec descend node depth =
+      if depth <= max_order then begin
+        let child = child_of node padded_ids.(i - depth) in
+        let count = Hashtbl.find_opt child.followers next_word |> Option.value ~default:0 in
+        Hashtbl.replace child.followers next_word (count + 1);
+        descend child (depth + 1)
+      end
+    in
+    descend trie 1
+  done
 
-  List.iter (fun tokens ->
-    let padded_tokens = start_padding @ tokens @ [end_marker] in
-    for i = 0 to List.length padded_tokens - order - 1 do
-      let key = list_slice padded_tokens i order in
-      let next_word = List.nth padded_tokens (i + order) in
-      add_transition key next_word
-    done
-  ) messages;
-  table
+let create_trie (v: vocab) (max_order: int) (messages: string list list) : context_trie =
+  let trie = create_trie_node () in
+  List.iter (fun tokens -> add_message trie max_order (Array.of_list (List.map (intern v) tokens))) messages;
+  trie
 
-let generate_sequence (table: transition_table) (order: int) (max_length: int) : string list =
-  let rec generate_aux current_state accumulated_words count =
-    if count >= max_length then accumulated_words
-    else
-      match Hashtbl.find_opt table current_state with
-      | None | Some [] -> accumulated_words
-      | Some options ->
-          let next_word = List.nth options (Random.int (List.length options)) in
-          if next_word = "<END>" then accumulated_words
-          else
-            let new_state = List.tl (current_state @ [next_word]) in
-            generate_aux new_state (accumulated_words @ [next_word]) (count + 1)
-  in
-  let initial_state = List.init order (fun _ -> "<START>") in
-  generate_aux initial_state [] 0
+(* --- Verbatim Copy Index --- *)
+
+(* Generated sentences should not parrot the corpus. The index holds a hash of every run of
+   verbatim_max_tokens + 1 consecutive tokens of every message and a fingerprint of every whole
+   message, so a sentence is checked with one rolling hash pass over it instead of a corpus scan.
+   Hashes are two polynomial hashes modulo 2^31 - 1 over the words' Hashtbl.hash, packed into one
+   int, which makes a false match about as likely as two 62-bit hashes colliding. *)
+
+let verbatim_max_tokens = 6   (* sentences may copy at most this many consecutive corpus tokens *)
+let fingerprint_min_tokens = 3 (* exact copies of shorter messages are fine, e.g. "lol" *)
+
+let hash_prime = 0x7FFFFFFF (* 2^31 - 1, a hash times a base still fits in a native int *)
+let hash_base_1 = 1_000_003
+let hash_base_2 = 998_244_353
+
+let word_hash (word: string) : int = Hashtbl.hash word
+
+let pack_hashes (h1: int) (h2: int) : int = (h1 lsl 31) lor h2
+
+let rec pow_mod (base: int) (exponent: int) : int =
+  if exponent = 0 then 1 else base * pow_mod base (exponent - 1) mod hash_prime
+
+(* Calls f with the packed hash of every run of n consecutive word hashes, rolling it along. *)
+let iter_window_hashes (n: int) (word_hashes: int array) (f: int -> unit) : unit =
+  let top_1 = pow_mod hash_base_1 (n - 1) in
+  let top_2 = pow_mod hash_base_2 (n - 1) in
+  let h1 = ref 0 in
+  let h2 = ref 0 in
+  Array.iteri (fun i word_hash ->
+    if i >= n then begin
+      (* drop the word that leaves the window *)
+      h1 := (!h1 + hash_prime - word_hashes.(i - n) * top_1 mod hash_prime) mod hash_prime;
+      h2 := (!h2 + hash_prime - word_hashes.(i - n) * top_2 mod hash_prime) mod hash_prime
+    end;
+    h1 := (!h1 * hash_base_1 + word_hash) mod hash_prime;
+    h2 := (!h2 * hash_base_2 + word_hash) mod hash_prime;
+    if i >= n - 1 then f (pack_hashes !h1 !h2)
+  ) word_hashes
+
+let fingerprint (word_hashes: int array) : int =
+  let h1, h2 = Array.fold_left (fun (h1, h2) word_hash ->
+    ((h1 * hash_base_1 + word_hash) mod hash_prime, (h2 * hash_base_2 + word_hash) mod hash_prime)
+  ) (0, 0) word_hashes in
+  pack_hashes h1 h2
+
+(* A growable array of packed hashes, 8 bytes per n-gram while the corpus streams past. *)
+type hash_buffer = {
+  mutable hashes : int array;
+  mutable length : int;
+}
+
+let create_hash_buffer () : hash_buffer = { hashes = Array.make 1024 0; length = 0 }
+
+let push_hash (buffer: hash_buffer) (hash: int) : unit =
+  if buffer.length = Array.length buffer.hashes then begin
+    let grown = Array.make (2 * buffer.length) 0 in
+    Array.blit buffer.hashes 0 grown 0 buffer.length;
+    buffer.hashes <- grown
+  end;
+  buffer.hashes.(buffer.length) <- hash;
+  buffer.length <- buffer.length + 1
+
+type verbatim_index = {
+  ngram_hashes : hash_buffer;
+  fingerprints : hash_buffer;
+}
+
+let create_verbatim_index () : verbatim_index =
+  { ngram_hashes = create_hash_buffer (); fingerprints = create_hash_buffer () }
+
+let index_message (index: verbatim_index) (tokens: string list) : unit =
+  let word_hashes = Array.of_list (List.map word_hash tokens) in
+  iter_window_hashes (verbatim_max_tokens + 1) word_hashes (push_hash index.ngram_hashes);
+  if Array.length word_hashes >= fingerprint_min_tokens then
+    push_hash index.fingerprints (fingerprint word_hashes)
 
 (* --- Message Filtering --- *)
 
@@ -88,53 +276,947 @@ let problematic_end_words = [
   "this"; "these"; "those"; "the"; "a"; "an"
 ]
 
-let is_bad_ending (words: string list) : bool =
-  match List.rev words with
+let problematic_end_word_set : (string, unit) Hashtbl.t =
+  let set = Hashtbl.create 64 in
+  List.iter (fun bad_word -> Hashtbl.replace set bad_word ()) problematic_end_words;
+  set
+
+let is_bad_end_word (word: string) : bool =
+  Hashtbl.mem problematic_end_word_set (String.lowercase_ascii word)
+
+(* --- Compiled Model --- *)
+
+(* A compiled model is one flat int32 array followed by the vocabulary's string bytes,
+   so it can be written to disk as is and mapped back with Unix.map_file without parsing.
+   Layout of the int32 part (offsets are in words, byte order is the host's):
+
+     header     magic, version, vocab size, max order, int32 words, text bytes,
+                string offsets offset, bad ending flags offset, node count,
+                node words offset, children offset, follower starts offset,
+                followers offset, cumulative counts offset, verbatim n-gram length,
+                word hashes offset, n-gram slots offset, n-gram slot count,
+                fingerprint slots offset, fingerprint slot count, normalisation flags
+     vocab      byte offset of every word in the text part (vocab size + 1 entries),
+                1 for every word that is a bad sentence ending, 0 otherwise
+     trie       the context trie's nodes numbered breadth first from the root (node 0), so the
+                children of every node are contiguous and sorted by word id:
+                the word id every node adds to its parent's context, the first child of every
+                node (node count + 1 entries), the first follower of every node (node count + 1
+                entries), follower word ids and cumulative follower counts per node, the followers
+                of a node are ordered <END> first, then words that are fine to end on, then bad
+                end words. The root has no followers.
+     verbatim   the Hashtbl.hash of every word (vocab size entries), then the n-gram hashes and
+                the message fingerprints of the verbatim copy index, each an open addressing
+                table of two words per slot holding packed hash + 1 split into its high and
+                low 31 bits, 0 0 is an empty slot
+
+   Word id 0 is always <START> and 1 is always <END>. *)
+
+module A1 = Bigarray.Array1
+
+type words = (int32, Bigarray.int32_elt, Bigarray.c_layout) A1.t
+type text = (char, Bigarray.int8_unsigned_elt, Bigarray.c_layout) A1.t
+
+let model_magic = 0x524F444D (* "RODM" *)
+let model_version = 5
+let header_words = 21
+
+let root_node = 0
+
+type model = {
+  data : words;
+  text : text;
+  vocab_size : int;
+  max_order : int;
+  str_offsets_off : int;
+  flags_off : int;
+  n_nodes : int;
+  node_words_off : int;
+  children_off : int;
+  starts_off : int;
+  followers_off : int;
+  cum_off : int;
+  verbatim_ngram : int;
+  word_hashes_off : int;
+  ngram_slots_off : int;
+  n_ngram_slots : int;
+  fingerprint_slots_off : int;
+  n_fingerprint_slots : int;
+  normalisation : normalisation;
+}
+
+let get (data: words) (i: int) : int = Int32.to_int (A1.get data i)
+let set (data: words) (i: int) (v: int) : unit = A1.set data i (Int32.of_int v)
+
+let model_of_data (data: words) (text: text) : model =
+  if A1.dim data < header_words || get data 0 <> model_magic then failwith "not a rod_gen model";
+  if get data 1 <> model_version then
+    failwith (Printf.sprintf "unsupported model version %d" (get data 1));
+  {
+    data;
+    text;
+    vocab_size = get data 2;
+    max_order = get data 3;
+    str_offsets_off = get data 6;
+    flags_off = get data 7;
+    n_nodes = get data 8;
+    node_words_off = get data 9;
+    children_off = get data 10;
+    starts_off = get data 11;
+    followers_off = get data 12;
+    cum_off = get data 13;
+    verbatim_ngram = get data 14;
+    word_hashes_off = get data 15;
+    ngram_slots_off = get data 16;
+    n_ngram_slots = get data 17;
+    fingerprint_slots_off = get data 18;
+    n_fingerprint_slots = get data 19;
+    normalisation = normalisation_of_flags (get data 20);
+  }
+
+let rec power_of_two_above (n: int) (acc: int) : int =
+  if acc >= n then acc else power_of_two_above n (acc * 2)
+
+let distinct_hashes (buffer: hash_buffer) : int array =
+  let hashes = Array.sub buffer.hashes 0 buffer.length in
+  Array.sort Int.compare hashes;
+  let n_distinct = ref 0 in
+  Array.iteri (fun i hash ->
+    if i = 0 || hash <> hashes.(i - 1) then begin
+      hashes.(!n_distinct) <- hash;
+      incr n_distinct
+    end
+  ) hashes;
+  Array.sub hashes 0 !n_distinct
+
+(* Slots of a hash set are two words, the packed hash + 1 in 31-bit halves so 0 0 stays empty. *)
+let fill_hash_set (data: words) (slots_off: int) (n_slots: int) (hashes: int array) : unit =
+  let mask = n_slots - 1 in
+  let rec free_slot slot =
+    if get data (slots_off + 2 * slot) = 0 && get data (slots_off + 2 * slot + 1) = 0 then slot
+    else free_slot ((slot + 1) land mask)
+  in
+  Array.iter (fun hash ->
+    let slot = free_slot (hash land mask) in
+    set data (slots_off + 2 * slot) ((hash + 1) lsr 31);
+    set data (slots_off + 2 * slot + 1) ((hash + 1) land 0x7FFFFFFF)
+  ) hashes
+
+let compile_model (vocab: vocab) (normalisation: normalisation) (max_order: int) (trie: context_trie)
+    (index: verbatim_index) : model =
+  let all_words = vocab_words vocab in
+
+  (* <END> first and bad end words last, so excluding either leaves one contiguous range *)
+  let follower_rank id = if id = end_id then 0 else if is_bad_end_word all_words.(id) then 2 else 1 in
+
+  (* number the nodes breadth first *)
+  let queue = Queue.create () in
+  Queue.add (start_id, trie) queue;
+  let entries_rev = ref [] in
+  while not (Queue.is_empty queue) do
+    let word_id, node = Queue.pop queue in
+    let children =
+      Hashtbl.fold (fun id child acc -> (id, child) :: acc) node.children []
+      |> List.sort (fun (a, _) (b, _) -> compare a b)
+    in
+    List.iter (fun child -> Queue.add child queue) children;
+    let follower_counts =
+      Hashtbl.fold (fun id count acc -> (follower_rank id, id, count) :: acc) node.followers []
+      |> List.sort compare
+      |> List.map (fun (_, id, count) -> (id, count))
+      |> Array.of_list
+    in
+    entries_rev := (word_id, List.length children, follower_counts) :: !entries_rev
+  done;
+  let entries = Array.of_list (List.rev !entries_rev) in
+
+  let vocab_size = Array.length all_words in
+  let text_bytes = Array.fold_left (fun n word -> n + String.length word) 0 all_words in
+  let n_nodes = Array.length entries in
+  let n_trans = Array.fold_left (fun n (_, _, counts) -> n + Array.length counts) 0 entries in
+  let str_offsets_off = header_words in
+  let flags_off = str_offsets_off + vocab_size + 1 in
+  let node_words_off = flags_off + vocab_size in
+  let children_off = node_words_off + n_nodes in
+  let starts_off = children_off + n_nodes + 1 in
+  let followers_off = starts_off + n_nodes + 1 in
+  let cum_off = followers_off + n_trans in
+  let ngram_hashes = distinct_hashes index.ngram_hashes in
+  let fingerprints = distinct_hashes index.fingerprints in
+  let n_ngram_slots = power_of_two_above (2 * Array.length ngram_hashes) 1 in
+  let n_fingerprint_slots = power_of_two_above (2 * Array.length fingerprints) 1 in
+  let word_hashes_off = cum_off + n_trans in
+  let ngram_slots_off = word_hashes_off + vocab_size in
+  let fingerprint_slots_off = ngram_slots_off + 2 * n_ngram_slots in
+
+  let data = A1.create Bigarray.int32 Bigarray.c_layout (fingerprint_slots_off + 2 * n_fingerprint_slots) in
+  let text = A1.create Bigarray.char Bigarray.c_layout text_bytes in
+  A1.fill data 0l;
+
+  List.iteri (fun i v -> set data i v) [
+    model_magic; model_version; vocab_size; max_order;
+    A1.dim data; text_bytes; str_offsets_off; flags_off;
+    n_nodes; node_words_off; children_off; starts_off;
+    followers_off; cum_off; verbatim_max_tokens + 1; word_hashes_off;
+    ngram_slots_off; n_ngram_slots; fingerprint_slots_off; n_fingerprint_slots;
+    normalisation_flags normalisation;
+  ];
+
+  let text_pos = ref 0 in
+  Array.iteri (fun id word ->
+    set data (str_offsets_off + id) !text_pos;
+    String.iteri (fun i c -> A1.set text (!text_pos + i) c) word;
+    text_pos := !text_pos + String.length word;
+    set data (flags_off + id) (if is_bad_end_word word then 1 else 0);
+    set data (word_hashes_off + id) (word_hash word)
+  ) all_words;
+  set data (str_offsets_off + vocab_size) !text_pos;
+
+  (* breadth first numbering puts the children of node i right after those of node i - 1 *)
+  let next_child = ref 1 in
+  let next_trans = ref 0 in
+  Array.iteri (fun i (word_id, n_children, follower_counts) ->
+    set data (node_words_off + i) word_id;
+    set data (children_off + i) !next_child;
+    next_child := !next_child + n_children;
+    set data (starts_off + i) !next_trans;
+    let cum = ref 0 in
+    Array.iter (fun (id, count) ->
+      cum := !cum + count;
+      set data (followers_off + !next_trans) id;
+      set data (cum_off + !next_trans) !cum;
+      incr next_trans
+    ) follower_counts
+  ) entries;
+  set data (children_off + n_nodes) !next_child;
+  set data (starts_off + n_nodes) !next_trans;
+
+  fill_hash_set data ngram_slots_off n_ngram_slots ngram_hashes;
+  fill_hash_set data fingerprint_slots_off n_fingerprint_slots fingerprints;
+
+  model_of_data data text
+
+(* Writes to a temporary file first, processes that still map the old model keep their pages. *)
+let save_model (m: model) (filename: string) : unit =
+  let tmp_filename = filename ^ ".tmp" in
+  let fd = Unix.openfile tmp_filename [Unix.O_RDWR; Unix.O_CREAT; Unix.O_TRUNC] 0o644 in
+  let n_words = A1.dim m.data in
+  let data = Unix.map_file fd Bigarray.int32 Bigarray.c_layout true [| n_words |] in
+  A1.blit m.data (Bigarray.array1_of_genarray data);
+  let text = Unix.map_file fd ~pos:(Int64.of_int (4 * n_words))
+      Bigarray.char Bigarray.c_layout true [| A1.dim m.text |] in
+  A1.blit m.text (Bigarray.array1_of_genarray text);
+  Unix.close fd;
+  Unix.rename tmp_filename filename
+
+let load_model (filename: string) : model =
+  let fd = Unix.openfile filename [Unix.O_RDONLY] 0 in
+  let map_words n =
+    Bigarray.array1_of_genarray (Unix.map_file fd Bigarray.int32 Bigarray.c_layout false [| n |])
+  in
+  let header = map_words header_words in
+  if get header 0 <> model_magic then failwith (filename ^ " is not a rod_gen model");
+  let n_words = get header 4 in
+  let data = map_words n_words in
+  let text = Unix.map_file fd ~pos:(Int64.of_int (4 * n_words))
+      Bigarray.char Bigarray.c_layout false [| get header 5 |] in
+  Unix.close fd;
+  model_of_data data (Bigarray.array1_of_genarray text)
+
+(* --- Sampling --- *)
+
+let word_of_id (m: model) (id: int) : string =
+  let start = get m.data (m.str_offsets_off + id) in
+  let stop = get m.data (m.str_offsets_off + id + 1) in
+  String.init (stop - start) (fun i -> A1.get m.text (start + i))
+
+let is_bad_end_id (m: model) (id: int) : bool =
+  get m.data (m.flags_off + id) <> 0
+
+(* Binary search among the node's children, which are sorted by word id. *)
+let find_child (m: model) (node: int) (word_id: int) : int option =
+  let rec search lo hi =
+    if lo >= hi then None
+    else
+      let mid = (lo + hi) / 2 in
+      let mid_word = get m.data (m.node_words_off + mid) in
+      if mid_word = word_id then Some mid
+      else if mid_word < word_id then search (mid + 1) hi
+      else search lo mid
+  in
+  search (get m.data (m.children_off + node)) (get m.data (m.children_off + node + 1))
+
+(* The trie nodes of ever longer contexts before the next word, deepest first. The accumulated
+   ids are the words so far, most recent first, and are padded with <START> like the corpus. *)
+let matching_nodes (m: model) (accumulated_ids: int list) : int list =
+  let rec walk node depth ids acc =
+    if depth > m.max_order then acc
+    else
+      let word_id, rest = match ids with id :: rest -> id, rest | [] -> start_id, [] in
+      match find_child m node word_id with
+      | None -> acc
+      | Some child -> walk child (depth + 1) rest (child :: acc)
+  in
+  walk root_node 1 accumulated_ids []
+
+let distinct_followers (m: model) (node: int) : int =
+  get m.data (m.starts_off + node + 1) - get m.data (m.starts_off + node)
+
+(* Binary search in [lo, hi] for the first follower whose cumulative count exceeds r. *)
+let rec search_cumulative (m: model) (lo: int) (hi: int) (r: int) : int =
+  if lo >= hi then lo
+  else
+    let mid = (lo + hi) / 2 in
+    if get m.data (m.cum_off + mid) > r then search_cumulative m lo mid r
+    else search_cumulative m (mid + 1) hi r
+
+(* Bad end words come last among a node's followers, so the first one can be binary searched. *)
+let first_bad_follower (m: model) (first: int) (stop: int) : int =
+  let rec search lo hi =
+    if lo >= hi then lo
+    else
+      let mid = (lo + hi) / 2 in
+      if is_bad_end_id m (get m.data (m.followers_off + mid)) then search lo mid else search (mid + 1) hi
+  in
+  search first stop
+
+let is_bad_ending (m: model) (ids: int list) : bool =
+  match List.rev ids with
   | [] -> true
-  | last_word :: _ ->
-      let last_word_lower = String.lowercase_ascii last_word in
-      List.exists (fun bad_word -> bad_word = last_word_lower) problematic_end_words
+  | last_id :: _ -> is_bad_end_id m last_id
 
-(* --- Main Generation Process --- *)
+(* The context of the given length before the next word, most recent word first, padded with <START>. *)
+let context_key (depth: int) (accumulated_ids: int list) : int array =
+  let key = Array.make depth start_id in
+  let rec fill i ids =
+    match ids with
+    | id :: rest when i < depth ->
+        key.(i) <- id;
+        fill (i + 1) rest
+    | _ -> ()
+  in
+  fill 0 accumulated_ids;
+  key
+
+(* --- Learned Messages --- *)
+
+(* Messages learned while serving are kept as count deltas next to the compiled model, which
+   stays read-only (and shared between processes) until the next checkpoint recompiles it.
+   Words the model does not know get ids after the model's vocabulary. *)
+type live_model = {
+  model : model;
+  base_ids : (string, int) Hashtbl.t Lazy.t; (* only built once the first message is learned *)
+  new_ids : (string, int) Hashtbl.t;
+  new_words : (int, string) Hashtbl.t;
+  learned : (int array, (int, int) Hashtbl.t) Hashtbl.t; (* context_key -> follower counts *)
+  learned_ngrams : (int, unit) Hashtbl.t;       (* the verbatim copy index of the learned messages *)
+  learned_fingerprints : (int, unit) Hashtbl.t;
+}
 
-let read_lines_from_file (filename: string) : string list =
-  let input_channel = open_in filename in
-  let rec read_acc acc =
-    try read_acc (input_line input_channel :: acc)
-    with End_of_file -> close_in input_channel; List.rev acc
+let create_live_model (m: model) : live_model =
+  let base_ids = lazy (
+    let ids = Hashtbl.create m.vocab_size in
+    for id = 0 to m.vocab_size - 1 do
+      Hashtbl.replace ids (word_of_id m id) id
+    done;
+    ids)
   in
-  read_acc []
+  {
+    model = m;
+    base_ids;
+    new_ids = Hashtbl.create 1024;
+    new_words = Hashtbl.create 1024;
+    learned = Hashtbl.create 1024;
+    learned_ngrams = Hashtbl.create 1024;
+    learned_fingerprints = Hashtbl.create 64;
+  }
 
-let () =
-  Random.self_init (); (* Initialize random number generator once *)
+let live_id (lm: live_model) (word: string) : int =
+  match Hashtbl.find_opt (Lazy.force lm.base_ids) word with
+  | Some id -> id
+  | None ->
+      (match Hashtbl.find_opt lm.new_ids word with
+       | Some id -> id
+       | None ->
+           let id = lm.model.vocab_size + Hashtbl.length lm.new_ids in
+           Hashtbl.add lm.new_ids word id;
+           Hashtbl.add lm.new_words id word;
+           id)
+
+let live_word_of_id (lm: live_model) (id: int) : string =
+  if id < lm.model.vocab_size then word_of_id lm.model id else Hashtbl.find lm.new_words id
 
-  let all_raw_messages = read_lines_from_file "text-files/all_messages_processed.txt" in
-  let processed_messages = List.map tokenize_line all_raw_messages in
+let live_is_bad_end_id (lm: live_model) (id: int) : bool =
+  if id < lm.model.vocab_size then is_bad_end_id lm.model id
+  else is_bad_end_word (Hashtbl.find lm.new_words id)
+
+(* Tokenised exactly like the corpus, then counted into every context length the model has
+   and added to the verbatim copy index. *)
+let learn_message (lm: live_model) (line: string) : unit =
+  let tokens = tokenize_line lm.model.normalisation line in
+  let word_hashes = Array.of_list (List.map word_hash tokens) in
+  iter_window_hashes lm.model.verbatim_ngram word_hashes (fun hash -> Hashtbl.replace lm.learned_ngrams hash ());
+  if Array.length word_hashes >= fingerprint_min_tokens then
+    Hashtbl.replace lm.learned_fingerprints (fingerprint word_hashes) ();
+  let ids = Array.of_list (List.map (live_id lm) tokens) in
+  let max_order = lm.model.max_order in
+  let padded_ids = Array.make (max_order + Array.length ids + 1) end_id in
+  Array.fill padded_ids 0 max_order start_id;
+  Array.blit ids 0 padded_ids max_order (Array.length ids);
+  for i = max_order to Array.length padded_ids - 1 do
+    for depth = 1 to max_order do
+      let key = Array.init depth (fun j -> padded_ids.(i - 1 - j)) in
+      let followers =
+        match Hashtbl.find_opt lm.learned key with
+        | Some followers -> followers
+        | None ->
+            let followers = Hashtbl.create 1 in
+            Hashtbl.add lm.learned key followers;
+            followers
+      in
+      let count = Hashtbl.find_opt followers padded_ids.(i) |> Option.value ~default:0 in
+      Hashtbl.replace followers padded_ids.(i) (count + 1)
+    done
+  done
 
-  let table_order_2 = create_markov_table 2 processed_messages in
-  let table_order_3 = create_markov_table 3 processed_messages in
+(* A context that was seen before, in the compiled trie, among the learned messages or both. *)
+type live_state = {
+  depth : int;
+  node : int option;
+  learned_followers : (int, int) Hashtbl.t option;
+}
 
-  let rec attempt_generation (tries: int) : string list =
-    if tries >= 1000 then [] (* Give up after too many tries *)
+(* The known contexts before the next word, deepest first. *)
+let live_states (lm: live_model) (accumulated_ids: int list) : live_state list =
+  let nodes = Array.of_list (List.rev (matching_nodes lm.model accumulated_ids)) in
+  let rec collect depth acc =
+    if depth > lm.model.max_order then acc
     else
-      let pick_order = if Random.bool () then 2 else 3 in
-      let current_table = if pick_order = 2 then table_order_2 else table_order_3 in
+      let node = if depth <= Array.length nodes then Some nodes.(depth - 1) else None in
+      let learned_followers =
+        if Hashtbl.length lm.learned = 0 then None
+        else Hashtbl.find_opt lm.learned (context_key depth accumulated_ids)
+      in
+      if Option.is_none node && Option.is_none learned_followers then acc
+      else collect (depth + 1) ({ depth; node; learned_followers } :: acc)
+  in
+  collect 1 []
+
+let backoff_min_followers = 2 (* contexts followed by fewer distinct words back off to shorter ones *)
+let backoff_min_order = 2     (* but sparse contexts never back off below this order *)
+
+(* Drops sparse states from the front of a deepest first list: a context the corpus only ever
+   continued one way just replays the corpus, a shorter one gives a real choice. *)
+let rec back_off (lm: live_model) (states: live_state list) : live_state list =
+  let distinct state =
+    (match state.node with Some node -> distinct_followers lm.model node | None -> 0)
+    + (match state.learned_followers with Some followers -> Hashtbl.length followers | None -> 0)
+  in
+  match states with
+  | state :: (next :: _ as shallower) when next.depth >= backoff_min_order && distinct state < backoff_min_followers ->
+      back_off lm shallower
+  | _ -> states
+
+(* Samples among the allowed followers of a state from both the compiled model and the learned
+   counts, <END> and bad end words can be left out. Returns None when no follower is left. *)
+let sample_allowed_follower (lm: live_model) (state: live_state)
+    ~(allow_end: bool) ~(allow_bad: bool) : int option =
+  let m = lm.model in
+  (* the compiled model's allowed followers are one range [lo, hi) *)
+  let base_range =
+    match state.node with
+    | None -> None
+    | Some node ->
+        let first = get m.data (m.starts_off + node) in
+        let stop = get m.data (m.starts_off + node + 1) in
+        let lo =
+          if not allow_end && first < stop && get m.data (m.followers_off + first) = end_id then first + 1
+          else first
+        in
+        let hi = if allow_bad then stop else first_bad_follower m first stop in
+        if lo >= hi then None
+        else
+          let cum_before = if lo = first then 0 else get m.data (m.cum_off + lo - 1) in
+          Some (lo, hi, cum_before, get m.data (m.cum_off + hi - 1) - cum_before)
+  in
+  let base_weight = match base_range with None -> 0 | Some (_, _, _, weight) -> weight in
+  let allowed id = (allow_end || id <> end_id) && (allow_bad || not (live_is_bad_end_id lm id)) in
+  let learned_followers =
+    match state.learned_followers with
+    | None -> []
+    | Some followers ->
+        Hashtbl.fold (fun id count acc -> if allowed id then (id, count) :: acc else acc) followers []
+  in
+  let learned_weight = List.fold_left (fun n (_, count) -> n + count) 0 learned_followers in
+  if base_weight + learned_weight = 0 then None
+  else
+    let r = Random.int (base_weight + learned_weight) in
+    match base_range with
+    | Some (lo, hi, cum_before, _) when r < base_weight ->
+        Some (get m.data (m.followers_off + search_cumulative m lo (hi - 1) (cum_before + r)))
+    | _ ->
+        let rec pick r = function
+          | [] -> None
+          | (id, count) :: rest -> if r < count then Some id else pick (r - count) rest
+        in
+        pick (r - base_weight) learned_followers
+
+(* Samples from the first state after backing off from sparse ones, or from shorter contexts
+   still when it has no allowed follower, so a dead end only happens when even order 1 has none. *)
+let sample_backing_off (lm: live_model) (accumulated_ids: int list)
+    ~(allow_end: bool) ~(allow_bad: bool) : int option =
+  let rec sample = function
+    | [] -> None
+    | state :: shallower ->
+        (match sample_allowed_follower lm state ~allow_end ~allow_bad with
+         | Some id -> Some id
+         | None -> sample shallower)
+  in
+  sample (back_off lm (live_states lm accumulated_ids))
+
+(* Samples until <END> or max_length without any constraint, bad endings are up to the caller. *)
+let generate_sequence (lm: live_model) (max_length: int) : int list =
+  let rec generate_aux accumulated_ids count =
+    if count >= max_length then List.rev accumulated_ids
+    else
+      match sample_backing_off lm accumulated_ids ~allow_end:true ~allow_bad:true with
+      | None -> List.rev accumulated_ids
+      | Some id when id = end_id -> List.rev accumulated_ids
+      | Some id -> generate_aux (id :: accumulated_ids) (count + 1)
+  in
+  generate_aux [] 0
+
+(* --- Constrained Generation --- *)
+
+let max_backtracks = 5
+
+(* Generates a sequence that never ends badly instead of rejecting it afterwards: <END> is only
+   sampled after a word that is fine to end on, and the last word before max_length is never a
+   bad end word. When no context length has an allowed follower the last word is resampled, up to
+   max_backtracks times, before giving up with None. *)
+let generate_constrained_sequence (lm: live_model) (max_length: int) : int list option =
+  let rec generate_aux accumulated_ids count backtracks =
+    let allow_end =
+      match accumulated_ids with
+      | [] -> false
+      | last_id :: _ -> not (live_is_bad_end_id lm last_id)
+    in
+    let allow_bad = count < max_length - 1 in
+    match sample_backing_off lm accumulated_ids ~allow_end ~allow_bad, accumulated_ids with
+    | Some id, _ when id = end_id -> Some (List.rev accumulated_ids)
+    | Some id, _ when count + 1 >= max_length -> Some (List.rev (id :: accumulated_ids))
+    | Some id, _ -> generate_aux (id :: accumulated_ids) (count + 1) backtracks
+    | None, _ :: rest when backtracks < max_backtracks -> generate_aux rest (count - 1) (backtracks + 1)
+    | None, _ -> None
+  in
+  generate_aux [] 0 0
+
+(* --- Verbatim Copy Filter --- *)
+
+let mem_hash_set (m: model) (slots_off: int) (n_slots: int) (hash: int) : bool =
+  let mask = n_slots - 1 in
+  let high = (hash + 1) lsr 31 in
+  let low = (hash + 1) land 0x7FFFFFFF in
+  let rec probe slot =
+    let slot_high = get m.data (slots_off + 2 * slot) in
+    let slot_low = get m.data (slots_off + 2 * slot + 1) in
+    if slot_high = 0 && slot_low = 0 then false
+    else (slot_high = high && slot_low = low) || probe ((slot + 1) land mask)
+  in
+  probe (hash land mask)
+
+let live_word_hash (lm: live_model) (id: int) : int =
+  if id < lm.model.vocab_size then get lm.model.data (lm.model.word_hashes_off + id)
+  else word_hash (Hashtbl.find lm.new_words id)
+
+(* Whether a sentence copies more than verbatim_max_tokens consecutive tokens of a corpus or
+   learned message, or a whole message. One pass over the sentence, whatever the corpus size. *)
+let copies_corpus (lm: live_model) (ids: int list) : bool =
+  let m = lm.model in
+  let word_hashes = Array.of_list (List.map (live_word_hash lm) ids) in
+  let copied = ref false in
+  iter_window_hashes m.verbatim_ngram word_hashes (fun hash ->
+    if mem_hash_set m m.ngram_slots_off m.n_ngram_slots hash || Hashtbl.mem lm.learned_ngrams hash then
+      copied := true
+  );
+  let is_whole_message () =
+    let hash = fingerprint word_hashes in
+    mem_hash_set m m.fingerprint_slots_off m.n_fingerprint_slots hash || Hashtbl.mem lm.learned_fingerprints hash
+  in
+  !copied || (Array.length word_hashes >= fingerprint_min_tokens && is_whole_message ())
+
+(* --- Main Generation Process --- *)
+
+(* Archives ending in .gz or .zst are decompressed on the fly by the gzip or zstd tools. *)
+let open_corpus (filename: string) : in_channel * (unit -> unit) =
+  let decompress tool =
+    let input_channel = Unix.open_process_in (tool ^ " -dc " ^ Filename.quote filename) in
+    let close () =
+      match Unix.close_process_in input_channel with
+      | Unix.WEXITED 0 -> ()
+      | _ -> failwith (Printf.sprintf "%s could not decompress %s" tool filename)
+    in
+    (input_channel, close)
+  in
+  if Filename.check_suffix filename ".gz" then decompress "gzip"
+  else if Filename.check_suffix filename ".zst" then decompress "zstd"
+  else
+    let input_channel = open_in filename in
+    (input_channel, fun () -> close_in input_channel)
+
+(* Streams the corpus one line at a time, only the current line is kept around. *)
+let iter_corpus_lines (filename: string) (f: string -> unit) : unit =
+  let input_channel, close = open_corpus filename in
+  let rec loop () =
+    match input_line input_channel with
+    | exception End_of_file -> ()
+    | line ->
+        f line;
+        loop ()
+  in
+  (try loop () with e -> close (); raise e);
+  close ()
 
-      let generated_words = generate_sequence current_table pick_order 15 in
+let iter_corpus (n: normalisation) (filename: string) (f: string list -> unit) : unit =
+  iter_corpus_lines filename (fun line -> f (tokenize_line n line))
 
-      if generated_words = [] || is_bad_ending generated_words then
-        attempt_generation (tries + 1) (* Retry if empty or bad ending *)
+let corpus_file = "text-files/all_messages_processed.txt"
+let model_file = "text-files/rod_model.bin"
+let model_max_order = 4 (* contexts of 1 up to this many words are counted, generation backs off between them *)
+
+(* Every order is filled in the same pass over the corpus, into the one trie, next to the verbatim copy index. *)
+let build_model ?(normalisation = default_normalisation) (filename: string) : model =
+  let vocab = create_vocab () in
+  let trie = create_trie_node () in
+  let index = create_verbatim_index () in
+  iter_corpus normalisation filename (fun tokens ->
+    add_message trie model_max_order (Array.of_list (List.map (intern vocab) tokens));
+    index_message index tokens
+  );
+  compile_model vocab normalisation model_max_order trie index
+
+(* Uses the compiled snapshot whenever there is one, messages learned since it was compiled
+   are replayed by the bot. The bot's RodGenPool (and senile-rod.sh) recompiles it before the
+   first worker starts when the corpus has changed, rebuilding here instead would count the
+   lines a worker is about to replay twice. *)
+let load_generator () : model =
+  if not (Sys.file_exists model_file) then build_model corpus_file
+  else
+    try load_model model_file
+    with Failure message ->
+      (* e.g. a snapshot from an older version, rebuilding beats not generating at all *)
+      prerr_endline (model_file ^ ": " ^ message ^ ", building from the corpus instead");
+      build_model corpus_file
+
+(* Counters for the serve mode's "stats" request. *)
+let sentences_generated = ref 0
+let generation_attempts = ref 0
+let generations_given_up = ref 0
+let verbatim_rejections = ref 0
+
+(* On a small corpus most sentences can copy it, so when every try did, the last copy is
+   used rather than nothing, a sentence is only empty when no try reached an ending. *)
+let generate_sentence (lm: live_model) : string =
+  incr sentences_generated;
+  let rec attempt_generation (tries: int) (last_copy: int list) : int list =
+    if tries >= 1000 then begin
+      incr generations_given_up;
+      last_copy (* Give up after too many tries *)
+    end
+    else begin
+      incr generation_attempts;
+      match generate_constrained_sequence lm 15 with
+      | Some generated_ids when copies_corpus lm generated_ids ->
+          incr verbatim_rejections;
+          attempt_generation (tries + 1) generated_ids (* Retry instead of parroting the corpus *)
+      | Some generated_ids -> generated_ids
+      | None -> attempt_generation (tries + 1) last_copy (* Retry on a dead end *)
+    end
+  in
+
+  attempt_generation 0 []
+  |> List.map (live_word_of_id lm)
+  |> String.concat " "
+  |> capitalize_string_first_char
+  |> replace_placeholder_with_space
+
+(* A seeded batch is reproducible, the generator is reseeded randomly afterwards. *)
+let generate_sentences ?seed (lm: live_model) (count: int) : string list =
+  Option.iter Random.init seed;
+  let sentences = List.init count (fun _ -> generate_sentence lm) in
+  if seed <> None then Random.self_init ();
+  sentences
+
+let sentences_to_json (sentences: string list) : string =
+  Yojson.Safe.to_string (`List (List.map (fun sentence -> `String sentence) sentences))
+
+let stats_to_json () : string =
+  Yojson.Safe.to_string (`Assoc [
+    ("sentences", `Int !sentences_generated);
+    ("attempts", `Int !generation_attempts);
+    ("gave_up", `Int !generations_given_up);
+    ("rejected_verbatim", `Int !verbatim_rejections);
+  ])
+
+(* --- Benchmarks --- *)
+
+let synthetic_corpus (n_messages: int) (mean_length: int) : string list list =
+  let words = Array.init 5_000 (fun i -> "w" ^ string_of_int i) in
+  (* skewed towards low indices, so some keys get many followers like in real chat *)
+  let random_word () = words.(Random.int (1 + Random.int (Array.length words))) in
+  List.init n_messages (fun _ -> List.init (1 + Random.int (2 * mean_length)) (fun _ -> random_word ()))
+
+let time_it (f: unit -> 'a) : 'a * float =
+  let started = Unix.gettimeofday () in
+  let result = f () in
+  (result, Unix.gettimeofday () -. started)
+
+(* Builds the trie and the compiled model for growing corpora and for growing message
+   lengths, ns/token stays flat when construction is linear in the total token count. *)
+let bench_build () =
+  Random.init 42;
+  let bench_case n_messages mean_length =
+    let messages = synthetic_corpus n_messages mean_length in
+    let n_tokens = List.fold_left (fun n tokens -> n + List.length tokens) 0 messages in
+    let _, seconds = time_it (fun () ->
+      let vocab = create_vocab () in
+      let index = create_verbatim_index () in
+      List.iter (index_message index) messages;
+      compile_model vocab default_normalisation model_max_order (create_trie vocab model_max_order messages) index)
+    in
+    Printf.printf "%9d messages %6d mean length %10d tokens %8.3f s %8.1f ns/token\n%!"
+      n_messages mean_length n_tokens seconds (seconds *. 1e9 /. float_of_int n_tokens)
+  in
+  List.iter (fun n_messages -> bench_case n_messages 10) [10_000; 100_000; 1_000_000];
+  List.iter (fun mean_length -> bench_case (1_000_000 / mean_length) mean_length) [10; 100; 1_000]
+
+(* The generator before constrained sampling, for comparison: a random fixed order of 2 or 3
+   without backoff, so a context the corpus never continued ends the sentence right there. *)
+let generate_fixed_order_sequence (m: model) (order: int) (max_length: int) : int list =
+  let rec generate_aux accumulated_ids count =
+    if count >= max_length then List.rev accumulated_ids
+    else
+      let nodes = matching_nodes m accumulated_ids in (* deepest first *)
+      if List.length nodes < order then List.rev accumulated_ids
       else
-        generated_words
+        let node = List.nth nodes (List.length nodes - order) in
+        let first = get m.data (m.starts_off + node) in
+        let stop = get m.data (m.starts_off + node + 1) in
+        let r = Random.int (get m.data (m.cum_off + stop - 1)) in
+        let id = get m.data (m.followers_off + search_cumulative m first (stop - 1) r) in
+        if id = end_id then List.rev accumulated_ids
+        else generate_aux (id :: accumulated_ids) (count + 1)
+  in
+  generate_aux [] 0
+
+(* Average attempts per sentence of the old generator, which threw away empty sentences and bad
+   endings, versus constrained sampling, on its own and with the verbatim copy filter on top. *)
+let bench_attempts (m: model) (n_sentences: int) =
+  let average_attempts succeeds =
+    let rec attempts tries = if succeeds () || tries + 1 >= 1000 then tries + 1 else attempts (tries + 1) in
+    let total = ref 0 in
+    for _i = 1 to n_sentences do
+      total := !total + attempts 0
+    done;
+    float_of_int !total /. float_of_int n_sentences
+  in
+  let lm = create_live_model m in
+  let rejection = average_attempts (fun () ->
+    let ids = generate_fixed_order_sequence m (if Random.bool () then 2 else 3) 15 in
+    ids <> [] && not (is_bad_ending m ids))
   in
+  let constrained = average_attempts (fun () ->
+    generate_constrained_sequence lm 15 <> None)
+  in
+  let filtered = average_attempts (fun () ->
+    match generate_constrained_sequence lm 15 with
+    | Some ids -> not (copies_corpus lm ids)
+    | None -> false)
+  in
+  Printf.printf "average attempts per sentence over %d sentences: %.3f rejection, %.3f constrained, %.3f constrained without verbatim copies\n"
+    n_sentences rejection constrained filtered
+
+(* --- Corpus Statistics --- *)
+
+(* Splits on single spaces only, like rod_gen did before normalisation, to compare against. *)
+let raw_tokens (line: string) : string list =
+  String.split_on_char ' ' line |> List.filter (fun word -> String.trim word <> "")
+
+let fan_out_buckets = [| "1"; "2"; "3-4"; "5-8"; "9-16"; "17+" |]
+
+let fan_out_bucket (distinct: int) : int =
+  let rec bucket k limit = if distinct <= limit || k = Array.length fan_out_buckets - 1 then k else bucket (k + 1) (limit * 2) in
+  bucket 0 1
+
+(* Vocabulary size and token counts with and without normalisation, then for every order the
+   contexts, how many distinct followers they have and the bytes they take in the compiled model. *)
+let corpus_stats (n: normalisation) (filename: string) =
+  let lines = ref 0 in
+  let n_raw_tokens = ref 0 in
+  let n_tokens = ref 0 in
+  let raw_vocab = Hashtbl.create 100_000 in
+  iter_corpus_lines filename (fun line ->
+    incr lines;
+    List.iter (fun token -> incr n_raw_tokens; Hashtbl.replace raw_vocab token ()) (raw_tokens line);
+    n_tokens := !n_tokens + List.length (tokenize_line n line)
+  );
+  let m = build_model ~normalisation:n filename in
+
+  Printf.printf "%d lines\n%-12s %12s %12s\n" !lines "" "raw" "normalised";
+  Printf.printf "%-12s %12d %12d\n" "tokens" !n_raw_tokens !n_tokens;
+  Printf.printf "%-12s %12d %12d\n\n" "vocabulary" (Hashtbl.length raw_vocab) (m.vocab_size - 2);
+
+  let mib bytes = float_of_int bytes /. 1048576. in
+  (* breadth first numbering makes every depth of the trie, so every order, one range of nodes *)
+  let rec report_order depth first stop =
+    if first < stop && depth <= m.max_order then begin
+      let n_transitions = get m.data (m.starts_off + stop) - get m.data (m.starts_off + first) in
+      let counts = Array.make (Array.length fan_out_buckets) 0 in
+      for node = first to stop - 1 do
+        let bucket = fan_out_bucket (distinct_followers m node) in
+        counts.(bucket) <- counts.(bucket) + 1
+      done;
+      let n_contexts = stop - first in
+      (* a node word, its first child and its first follower, then a follower id and cumulative count *)
+      let bytes = 4 * (3 * n_contexts + 2 * n_transitions) in
+      Printf.printf "order %d: %d contexts, %d transitions, %.2f followers per context, %.1f MiB\n"
+        depth n_contexts n_transitions (float_of_int n_transitions /. float_of_int n_contexts) (mib bytes);
+      Printf.printf "  distinct followers:";
+      Array.iteri (fun i count ->
+        Printf.printf " %s %.1f%%" fan_out_buckets.(i) (100. *. float_of_int count /. float_of_int n_contexts)
+      ) counts;
+      print_newline ();
+      report_order (depth + 1) (get m.data (m.children_off + first)) (get m.data (m.children_off + stop))
+    end
+  in
+  report_order 1 (get m.data (m.children_off + root_node)) (get m.data (m.children_off + root_node + 1));
 
-  let final_words = attempt_generation 0 in
+  let text_bytes = A1.dim m.text in
+  (* string offsets, bad end word flags and word hashes, then the words themselves *)
+  let vocab_bytes = 4 * (3 * m.vocab_size + 1) + text_bytes in
+  let index_bytes = 8 * (m.n_ngram_slots + m.n_fingerprint_slots) in
+  Printf.printf "\nvocabulary %.1f MiB, verbatim copy index %.1f MiB, whole model %.1f MiB\n"
+    (mib vocab_bytes) (mib index_bytes) (mib (4 * A1.dim m.data + text_bytes))
 
-  let final_sentence =
-    final_words
-    |> String.concat " "
-    |> capitalize_string_first_char
-    |> replace_placeholder_with_space
+(* --- Serve Mode --- *)
+
+(* Line protocol for the bot's resident worker: one request per line on stdin,
+   one response per line on stdout. "ready" is printed once the model is loaded.
+
+     gen            a generated sentence
+     gen <n> [seed] a JSON array of n generated sentences, 0 <= n <= max_batch_size
+     learn <line>   counts a corpus line into the live model, answers "ok"
+     reload         maps the model snapshot again and forgets learned lines, answers "ok"
+     stats          JSON counters of sentences, generation attempts, given up generations and
+                    sentences rejected for copying the corpus
+     ping           "pong" *)
+let max_batch_size = 1000 (* larger batches would run past the bot's request timeout anyway *)
+
+let serve (m: model) =
+  let live = ref (create_live_model m) in
+  let respond line =
+    print_endline line;
+    flush stdout
+  in
+  let rec loop () =
+    match input_line stdin with
+    | exception End_of_file -> ()
+    | request ->
+        let command, argument =
+          match String.index_opt request ' ' with
+          | Some i -> String.sub request 0 i, String.sub request (i + 1) (String.length request - i - 1)
+          | None -> String.trim request, ""
+        in
+        (match command with
+         | "gen" when argument = "" -> respond (generate_sentence !live)
+         | "gen" ->
+             (match List.map int_of_string_opt (String.split_on_char ' ' (String.trim argument)) with
+              | (Some count :: _) when count < 0 || count > max_batch_size ->
+                  respond (Printf.sprintf "error: gen count must be between 0 and %d, got %d" max_batch_size count)
+              | [Some count] -> respond (sentences_to_json (generate_sentences !live count))
+              | [Some count; Some seed] -> respond (sentences_to_json (generate_sentences ~seed !live count))
+              | _ -> respond ("error: expected gen [count [seed]], got gen " ^ argument))
+         | "learn" ->
+             learn_message !live argument;
+             respond "ok"
+         | "reload" ->
+             live := create_live_model (load_generator ());
+             respond "ok"
+         | "stats" -> respond (stats_to_json ())
+         | "ping" -> respond "pong"
+         | other -> respond ("error: unknown request " ^ other));
+        loop ()
+  in
+  respond "ready";
+  loop ()
+
+(* Takes the normalisation options out of the arguments, the rest keep their order. Every option
+   has a --no- form, options that are not given keep their default. None when none was given. *)
+let parse_normalisation (args: string list) : normalisation option * string list =
+  let set_option n arg =
+    match arg with
+    | "--lowercase" -> Some { n with lowercase = true }
+    | "--no-lowercase" -> Some { n with lowercase = false }
+    | "--split-emoji" -> Some { n with split_emoji = true }
+    | "--no-split-emoji" -> Some { n with split_emoji = false }
+    | "--canonical-mentions" -> Some { n with canonical_mentions = true }
+    | "--no-canonical-mentions" -> Some { n with canonical_mentions = false }
+    | "--strip-url-queries" -> Some { n with strip_url_queries = true }
+    | "--no-strip-url-queries" -> Some { n with strip_url_queries = false }
+    | _ -> None
   in
+  let normalisation, rest_rev = List.fold_left (fun (n, rest_rev) arg ->
+    match set_option (Option.value n ~default:default_normalisation) arg with
+    | Some n -> (Some n, rest_rev)
+    | None -> (n, arg :: rest_rev)
+  ) (None, []) args in
+  (normalisation, List.rev rest_rev)
+
+(* The normalisation an existing snapshot was built with, None if there is no readable one. *)
+let stored_normalisation (filename: string) : normalisation option =
+  match load_model filename with
+  | m -> Some m.normalisation
+  | exception (Failure _ | Invalid_argument _ | Sys_error _ | Unix.Unix_error _) -> None
+
+let () =
+  Random.self_init (); (* Initialize random number generator once *)
 
-  print_endline final_sentence
+  match List.tl (Array.to_list Sys.argv) with
+  | "--compile" :: args ->
+      (* rod_gen.exe --compile [normalisation options] [corpus] [model]
+         without normalisation options the snapshot being replaced keeps its normalisation, so the
+         bot's checkpoints and senile-rod.sh do not undo the options it was compiled with *)
+      let normalisation, args = parse_normalisation args in
+      let corpus, output =
+        match args with
+        | [] -> corpus_file, model_file
+        | [corpus] -> corpus, model_file
+        | corpus :: output :: _ -> corpus, output
+      in
+      let normalisation =
+        match normalisation with
+        | Some n -> n
+        | None -> Option.value (stored_normalisation output) ~default:default_normalisation
+      in
+      save_model (build_model ~normalisation corpus) output
+  | "--stats" :: args ->
+      (* rod_gen.exe --stats [normalisation options] [corpus] *)
+      let normalisation, args = parse_normalisation args in
+      corpus_stats (Option.value normalisation ~default:default_normalisation) (match args with corpus :: _ -> corpus | [] -> corpus_file)
+  | ["--serve"] -> serve (load_generator ())
+  | ["--bench-build"] -> bench_build ()
+  | ["--bench-attempts"] -> bench_attempts (load_generator ()) 10_000
+  | _ ->
+      (* rod_gen.exe [-n count] [--seed seed] [--json] *)
+      let count = ref 1 in
+      let seed = ref None in
+      let json = ref false in
+      let specs = [
+        ("-n", Arg.Set_int count, "count generate this many sentences (default 1)");
+        ("--seed", Arg.Int (fun s -> seed := Some s), "seed make the output reproducible");
+        ("--json", Arg.Set json, " print a JSON array instead of one sentence per line");
+      ] in
+      Arg.parse specs (fun arg -> raise (Arg.Bad ("unexpected argument " ^ arg))) "rod_gen.exe [options]";
+      let sentences = generate_sentences ?seed:!seed (create_live_model (load_generator ())) !count in
+      if !json then print_endline (sentences_to_json sentences)
+      else List.iter print_endline sentences
@@ -0,0 +1,106 @@
+"""
+A generation service shared by several bot processes: one RodGenPool behind a Unix socket.
+Bot processes started with ROD_GEN_SOCKET set talk to it through generator.RodGenClient instead of
+running their own workers, so all of them learn into the same corpus and model snapshot.
+
+    python3 rod_gen_service.py --socket rod_gen.sock --workers 4
+
+The workers' metrics (queue wait, failures, generated sentences and attempts) are counted here rather
+than in the bot processes, so the service serves them itself, on --metrics-port and/or --metrics-json.
+
+The protocol is one request per line and one response line per request:
+    gen                 a sentence
+    gen <n> [seed]      a JSON list of n sentences
+    learn <line>        appends a corpus line, answers "ok"
+    checkpoint          recompiles the model snapshot with the learned lines, answers "ok"
+    ping                answers "pong"
+Failed requests are answered with "error: <message>".
+"""
+import argparse
+import asyncio
+import json
+import os
+from typing import Optional
+
+from generator import STREAM_LIMIT, RodGenError, RodGenPool
+from metrics import dump_metrics_periodically, serve_metrics
+
+DEFAULT_SOCKET = "rod_gen.sock"
+DEFAULT_METRICS_PORT = 9107 # next to the bots' 9108 and up
+
+
+async def respond(pool: RodGenPool, request: str) -> str:
+    command, _, argument = request.partition(" ")
+    if command == "gen":
+        if not argument:
+            return await pool.generate()
+        parts = argument.split()
+        n = int(parts[0])
+        seed = int(parts[1]) if len(parts) > 1 else None
+        return json.dumps(await pool.generate(n, seed=seed))
+    if command == "learn":
+        await pool.learn(argument)
+        return "ok"
+    if command == "checkpoint":
+        await pool.checkpoint()
+        return "ok"
+    if command == "ping":
+        return "pong"
+    raise ValueError(f"unknown request: {request}")
+
+
+async def handle_connection(pool: RodGenPool, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        while line := await reader.readline():
+            try:
+                response = await respond(pool, line.decode().rstrip("\n"))
+            except (RodGenError, OSError, ValueError) as e:
+                response = "error: " + " ".join(str(e).split())  # the response has to stay on one line
+            writer.write(response.encode() + b"\n")
+            await writer.drain()
+    except ConnectionResetError:
+        pass  # the bot process went away
+    finally:
+        writer.close()
+
+
+async def serve(socket_path: str, workers: int, timeout: float, metrics_port: int, metrics_json: Optional[str] = None):
+    pool = RodGenPool(workers, timeout=timeout)
+    await pool.start()
+    if metrics_port:
+        await serve_metrics(port=metrics_port)
+        print(f"Serving metrics on http://127.0.0.1:{metrics_port}/metrics")
+    if metrics_json:
+        asyncio.create_task(dump_metrics_periodically(metrics_json))
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)  # left behind by a previous run
+    server = await asyncio.start_unix_server(
+        lambda reader, writer: handle_connection(pool, reader, writer), path=socket_path, limit=STREAM_LIMIT
+    )
+    print(f"Serving {workers} rod_gen worker(s) on {socket_path}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await pool.stop()
+        os.unlink(socket_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve rod_gen to several bot processes over a Unix socket.")
+    parser.add_argument("--socket", default=os.getenv("ROD_GEN_SOCKET", DEFAULT_SOCKET), help="path of the Unix socket")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("ROD_GEN_WORKERS", min(4, os.cpu_count() or 1))), help="amount of rod_gen processes")
+    parser.add_argument("--timeout", type=float, default=10, help="seconds a single generation may take")
+    parser.add_argument("--metrics-port", type=int, default=int(os.getenv("ROD_GEN_METRICS_PORT", DEFAULT_METRICS_PORT)),
+                        help="local port serving /metrics and /metrics.json, 0 turns it off")
+    parser.add_argument("--metrics-json", default=os.getenv("ROD_GEN_METRICS_JSON_FILE"),
+                        help="also write the metrics to this file every minute")
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.socket, args.workers, args.timeout, args.metrics_port, args.metrics_json))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
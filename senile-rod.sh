@@ -2,4 +2,8 @@
 
 eval $(opam env)
 dune build
+# recompile the markov model snapshot whenever the corpus is newer than it, e.g. after learning new messages,
+# or rod_gen itself is, its snapshot format may have changed
+[ text-files/rod_model.bin -nt text-files/all_messages_processed.txt ] && [ text-files/rod_model.bin -nt _build/default/rod_gen.exe ] \
+  || ./_build/default/rod_gen.exe --compile
 python3 bot.py
@@ -0,0 +1,168 @@
+"""
+The slot machine behind the gamble and winnings commands, and the numbers behind it.
+`resolve_spin` is what the gamble command pays out, `expected_value` works out the exact return per
+spin from the weight table, and `simulate` spins the machine in batches to check it (with NumPy
+arrays if NumPy is installed, plain Python otherwise). Both go through a table of what `resolve_spin`
+pays for every combination of reels, so they can never disagree with the gamble command.
+
+    python3 slot_machine.py --spins 10000000
+"""
+import argparse
+import functools
+import itertools
+import math
+import random
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None  # simulate falls back to plain Python
+
+SLOT_EMOJIS = ["🍒", "🔔", "⭐", "💎", "💰", "7️⃣", "BAR"]  # emojis used as options in our slot machine
+SLOT_WEIGHTS = [800, 150, 80, 40, 20, 10, 100]             # their weights, i.e. how likely are they to appear
+
+# the slot payouts, necessary for showing what you won and for the winnings command
+SLOT_PAYOUTS = {
+    "7️⃣": 5000,
+    "💰": 1000,
+    "💎": 500,
+    "BAR": 75,
+    "⭐": 100,
+    "🔔": 50,
+    "🍒": 10
+}
+SLOT_COST_PER_SPIN = 5 # 'price' for a spin of the slot machine
+
+TRIPLE_MESSAGES = {
+    "7️⃣": "**🎰 TRIPLE SEVEN JACKPOT! You won ${payout}!**",
+    "💰": "**💸 MONEY BAG MADNESS! You won ${payout}!**",
+    "💎": "**💎 DIAMOND DELIGHT! You won ${payout}! **",
+    "⭐": "**⭐ STARBURST! You won ${payout}!**",
+    "🔔": "**🔔 RING-A-DING-DING! You won ${payout}!**",
+    "BAR": "**📊 BAR BONANZA! You won ${payout}!**",
+    "🍒": "**🍒🍒🍒 Cherry Jackpot! You won ${payout}!**",
+}
+PAIR_MESSAGE = "**Almost! Try again!**"
+LOSS_MESSAGE = "**Better luck next time! No wins this spin.**"
+SIMULATION_BATCH_SIZE = 1_000_000 # spins drawn at once by simulate
+
+
+def spin(rng=random) -> list:
+    """Draws the three reels."""
+    return rng.choices(SLOT_EMOJIS, weights=SLOT_WEIGHTS, k=3)
+
+
+def resolve_spin(reels) -> tuple:
+    """Returns (payout, message) for three reels, only three of a kind pays out."""
+    reel1, reel2, reel3 = reels
+    if reel1 == reel2 == reel3:
+        payout = SLOT_PAYOUTS.get(reel1, 0)
+        return payout, TRIPLE_MESSAGES[reel1].format(payout=payout)
+    if reel1 == reel2 or reel1 == reel3 or reel2 == reel3:
+        return 0, PAIR_MESSAGE
+    return 0, LOSS_MESSAGE
+
+
+def _probabilities() -> list:
+    total = sum(SLOT_WEIGHTS)
+    return [weight / total for weight in SLOT_WEIGHTS]
+
+
+@functools.lru_cache(maxsize=None)
+def _payout_table() -> tuple:
+    """What resolve_spin pays for every combination of reels, indexed by the reels' emoji indices."""
+    return tuple(
+        tuple(tuple(resolve_spin((SLOT_EMOJIS[i], SLOT_EMOJIS[j], SLOT_EMOJIS[k]))[0] for k in range(len(SLOT_EMOJIS)))
+              for j in range(len(SLOT_EMOJIS)))
+        for i in range(len(SLOT_EMOJIS))
+    )
+
+
+def expected_value() -> dict:
+    """
+    The exact return of a spin, from every combination of reels in the payout table. Each reel is
+    drawn independently, so reels i, j and k have probability p_i * p_j * p_k.
+    """
+    probabilities = _probabilities()
+    table = _payout_table()
+    outcomes = [
+        (probabilities[i] * probabilities[j] * probabilities[k], table[i][j][k])
+        for i, j, k in itertools.product(range(len(SLOT_EMOJIS)), repeat=3)
+    ]
+    mean_payout = sum(p * payout for p, payout in outcomes)
+    variance = sum(p * payout ** 2 for p, payout in outcomes) - mean_payout ** 2
+    return {
+        "rtp": mean_payout / SLOT_COST_PER_SPIN,
+        "hit_frequency": sum(p for p, payout in outcomes if payout > 0),
+        "mean_payout": mean_payout,
+        "net_per_spin": mean_payout - SLOT_COST_PER_SPIN,
+        "variance": variance,
+    }
+
+
+def _batch_totals_numpy(rng, batch: int) -> tuple:
+    reels = rng.choice(len(SLOT_EMOJIS), size=(batch, 3), p=_probabilities())
+    table = numpy.array(_payout_table(), dtype=numpy.float64)
+    payouts = table[reels[:, 0], reels[:, 1], reels[:, 2]]
+    return float(payouts.sum()), float((payouts ** 2).sum()), int(numpy.count_nonzero(payouts))
+
+
+def _batch_totals_python(rng, batch: int) -> tuple:
+    total = squares = hits = 0
+    for _ in range(batch):
+        payout, _ = resolve_spin(spin(rng))
+        if payout:
+            total += payout
+            squares += payout ** 2
+            hits += 1
+    return total, squares, hits
+
+
+def simulate(n_spins: int, seed=None, batch_size: int = SIMULATION_BATCH_SIZE) -> dict:
+    """Spins the machine n_spins times, in batches of batch_size, and reports the same numbers as expected_value."""
+    if n_spins < 1:
+        raise ValueError(f"the simulation needs at least one spin, got {n_spins}")
+    if numpy is not None:
+        rng, batch_totals = numpy.random.default_rng(seed), _batch_totals_numpy
+    else:
+        rng, batch_totals = random.Random(seed), _batch_totals_python
+    total = squares = hits = 0
+    for start in range(0, n_spins, batch_size):
+        batch_total, batch_squares, batch_hits = batch_totals(rng, min(batch_size, n_spins - start))
+        total += batch_total
+        squares += batch_squares
+        hits += batch_hits
+    mean_payout = total / n_spins
+    variance = squares / n_spins - mean_payout ** 2
+    return {
+        "rtp": mean_payout / SLOT_COST_PER_SPIN,
+        "hit_frequency": hits / n_spins,
+        "mean_payout": mean_payout,
+        "net_per_spin": mean_payout - SLOT_COST_PER_SPIN,
+        "variance": variance,
+        "rtp_standard_error": math.sqrt(variance / n_spins) / SLOT_COST_PER_SPIN,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the exact and simulated return of the slot machine.")
+    parser.add_argument("--spins", type=int, default=10_000_000)
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+    if args.spins < 1:
+        parser.error("--spins has to be at least 1")
+
+    exact = expected_value()
+    started = time.perf_counter()
+    simulated = simulate(args.spins, seed=args.seed)
+    seconds = time.perf_counter() - started
+    print(f"{'':>14} {'exact':>12} {'simulated':>12}")
+    for key in exact:
+        print(f"{key:>14} {exact[key]:>12.6f} {simulated[key]:>12.6f}")
+    print(f"{args.spins} spins in {seconds:.2f}s ({'NumPy' if numpy is not None else 'plain Python'}), "
+          f"RTP standard error {simulated['rtp_standard_error']:.6f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+import asyncio
+import fcntl
+import json
+import os
+
+
+class StateStore:
+    """
+    A small JSON file of bot state kept in memory.
+    Reads and updates only touch memory, updates are written to disk in the background after
+    `flush_delay` seconds, so a burst of updates ends up as one write. Writes go to a temporary
+    file that is then renamed over the old one, so a crash never leaves a truncated file behind.
+    """
+
+    def __init__(self, path: str, flush_delay: float = 1.0):
+        self.path = path
+        self.flush_delay = flush_delay
+        self.data = self._load()
+        self._dirty = False
+        self._flush_task = None
+        self._write_lock = asyncio.Lock()
+
+    def _load(self) -> dict:
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, 'r') as f:
+            return json.load(f)
+
+    def get(self, key: str, default=None):
+        return self.data.get(key, default)
+
+    def set(self, key: str, value):
+        self.data[key] = value
+        self._dirty = True
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_later())
+
+    def increment(self, key: str) -> int:
+        """Adds one to a counter and returns the new value, without waiting on the disk."""
+        value = self.data.get(key, 0) + 1
+        self.set(key, value)
+        return value
+
+    async def _flush_later(self):
+        while self._dirty:
+            await asyncio.sleep(self.flush_delay)
+            await self.flush()
+
+    async def flush(self):
+        """Writes the current state to disk off the event loop, if anything changed."""
+        async with self._write_lock:
+            if not self._dirty:
+                return
+            self._dirty = False
+            contents = json.dumps(self.data)
+            try:
+                await asyncio.to_thread(_atomic_write, self.path, contents)
+            except OSError:
+                self._dirty = True
+                raise
+
+    def flush_now(self):
+        """Blocking flush, for when the event loop is already gone (e.g. on shutdown)."""
+        if self._dirty:
+            _atomic_write(self.path, json.dumps(self.data))
+            self._dirty = False
+
+
+class SharedCounter:
+    """
+    A counter in a JSON file that several processes increment, each increment reads and writes the
+    file under an exclusive flock on `<path>.lock`, so no two processes ever get the same value.
+    The counter never counts from below `floor`, e.g. a value another store kept counting in meanwhile.
+    """
+
+    def __init__(self, path: str, key: str, floor: int = 0):
+        self.path = path
+        self.key = key
+        self.floor = floor
+
+    async def increment(self) -> int:
+        """Adds one to the counter and returns the new value, the file work runs off the event loop."""
+        return await asyncio.to_thread(self._increment)
+
+    def read(self) -> int:
+        """Blocking read of the current value, under a shared flock so no increment is halfway."""
+        with open(self.path + ".lock", 'a') as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_SH)
+            return max(self._load().get(self.key, 0), self.floor)
+
+    def _increment(self) -> int:
+        with open(self.path + ".lock", 'a') as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            data = self._load()
+            value = max(data.get(self.key, 0), self.floor) + 1
+            data[self.key] = value
+            _atomic_write(self.path, json.dumps(data))
+        return value  # the lock is dropped when lock_file is closed
+
+    def _load(self) -> dict:
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, 'r') as f:
+            return json.load(f)
+
+
+def _atomic_write(path: str, contents: str):
+    tmp_path = f"{path}.{os.getpid()}.tmp" # per process, several bot processes may share the file
+    with open(tmp_path, 'w') as f:
+        f.write(contents)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
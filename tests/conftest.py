@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the bot's modules live at the top of the repo, next to bot.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
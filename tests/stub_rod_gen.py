@@ -0,0 +1,63 @@
+"""
+A stand-in for rod_gen.exe speaking the same line protocol, so the pool can be tested without OCaml.
+The "model" is just the list of corpus lines, `lines` answers it as JSON.
+
+    stub_rod_gen.py --serve <model file> [--hang]     --hang never answers a gen request
+    stub_rod_gen.py --compile <corpus file> <model file> [--sleep seconds]
+"""
+import json
+import os
+import shutil
+import sys
+import time
+
+
+def load(model_file: str) -> list:
+    if not os.path.exists(model_file):
+        return []
+    with open(model_file, encoding='utf-8') as f:
+        return f.read().splitlines()
+
+
+def serve(model_file: str, hang: bool):
+    lines = load(model_file)
+    stats = {"sentences": 0, "attempts": 0, "gave_up": 0, "rejected_verbatim": 0}
+    print("ready", flush=True)
+    for request in sys.stdin:
+        command, _, argument = request.rstrip("\n").partition(" ")
+        if command == "gen" and hang:
+            time.sleep(3600)
+        if command == "gen" and not argument:
+            response = lines[-1] if lines else ""
+            stats["sentences"] += 1
+        elif command == "gen":
+            n = int(argument.split()[0])
+            response = json.dumps([f"sentence {i}" for i in range(n)])
+            stats["sentences"] += n
+        elif command == "learn":
+            lines.append(argument)
+            response = "ok"
+        elif command == "reload":
+            lines = load(model_file)
+            response = "ok"
+        elif command == "lines":
+            response = json.dumps(lines)
+        elif command == "stats":
+            response = json.dumps(stats)
+        else:
+            response = f"error: unknown request: {command}"
+        print(response, flush=True)
+
+
+def main():
+    mode = sys.argv[1]
+    if mode == "--serve":
+        serve(sys.argv[2], "--hang" in sys.argv)
+    elif mode == "--compile":
+        if "--sleep" in sys.argv:
+            time.sleep(float(sys.argv[sys.argv.index("--sleep") + 1]))
+        shutil.copyfile(sys.argv[2], sys.argv[3])
+
+
+if __name__ == "__main__":
+    main()
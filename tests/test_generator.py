@@ -0,0 +1,169 @@
+import asyncio
+import json
+import os
+import sys
+
+import pytest
+
+from generator import MAX_BATCH_SIZE, RodGenError, RodGenPool, SentencePool
+
+STUB = (sys.executable, os.path.join(os.path.dirname(__file__), "stub_rod_gen.py"))
+
+
+def make_pool(tmp_path, size=1, timeout=5, hang=False, compile_sleep=0, compile_timeout=10):
+    corpus_file = str(tmp_path / "corpus.txt")
+    model_file = str(tmp_path / "model.bin")
+    with open(corpus_file, 'w', encoding='utf-8') as f:
+        f.write("first line\nsecond line\n")
+    serve = (*STUB, "--serve", model_file, *(("--hang",) if hang else ()))
+    compile_command = (*STUB, "--compile", corpus_file, model_file, "--sleep", str(compile_sleep))
+    return RodGenPool(size, timeout=timeout, command=serve, compile_command=compile_command,
+                      corpus_file=corpus_file, model_file=model_file, compile_timeout=compile_timeout)
+
+
+async def worker_lines(pool: RodGenPool) -> list:
+    return json.loads(await pool.request("lines"))
+
+
+def test_stale_snapshot_is_compiled_before_the_first_worker(tmp_path):
+    async def run():
+        pool = make_pool(tmp_path)
+        await pool.start()
+        try:
+            assert await worker_lines(pool) == ["first line", "second line"]
+        finally:
+            await pool.stop()
+
+    asyncio.run(run())
+
+
+def test_timed_out_worker_is_killed_and_restarted(tmp_path):
+    async def run():
+        pool = make_pool(tmp_path, timeout=0.5, hang=True)
+        await pool.start()
+        try:
+            worker = pool.workers[0]
+            process = worker.process
+            with pytest.raises(RodGenError, match="did not answer"):
+                await pool.generate()
+            assert not worker.running
+            await process.wait()  # the hung process was killed, not left behind
+            assert await worker_lines(pool) == ["first line", "second line"]
+            assert worker.process is not process
+        finally:
+            await pool.stop()
+
+    asyncio.run(run())
+
+
+def test_learned_lines_are_replayed_across_a_checkpoint(tmp_path):
+    async def run():
+        pool = make_pool(tmp_path, size=2)
+        await pool.start()
+        try:
+            await pool.learn("third line")
+            assert await worker_lines(pool) == ["first line", "second line", "third line"]
+            await pool.checkpoint()
+            assert pool.learned == []
+            await pool.learn("fourth line")
+            expected = ["first line", "second line", "third line", "fourth line"]
+            for _ in pool.workers:  # each worker reloads the snapshot and replays only what is not in it
+                assert await worker_lines(pool) == expected
+        finally:
+            await pool.stop()
+
+    asyncio.run(run())
+
+
+def test_learning_during_a_checkpoint_does_not_wait_on_the_compile(tmp_path):
+    async def run():
+        pool = make_pool(tmp_path)
+        await pool.start()
+        try:
+            await pool.learn("third line")
+            pool.compile_command = (*pool.compile_command[:-1], "1")  # make the compile take a second
+            checkpoint = asyncio.create_task(pool.checkpoint())
+            await asyncio.sleep(0.3)
+            await asyncio.wait_for(pool.learn("fourth line"), timeout=0.1)
+            await checkpoint
+            assert pool.learned == [(2, "fourth line")]
+            with open(pool.corpus_file, encoding='utf-8') as f:
+                assert f.read().splitlines()[-2:] == ["third line", "fourth line"]
+            assert (await worker_lines(pool))[-2:] == ["third line", "fourth line"]
+        finally:
+            await pool.stop()
+
+    asyncio.run(run())
+
+
+def test_hung_compile_is_killed(tmp_path):
+    async def run():
+        pool = make_pool(tmp_path, compile_sleep=30, compile_timeout=0.5)
+        pool._snapshot_checked = True
+        await pool.learn("third line")
+        with pytest.raises(RodGenError, match="did not finish"):
+            await pool.checkpoint()
+        await asyncio.wait_for(pool.learn("fourth line"), timeout=1)
+        assert [line for _, line in pool.learned] == ["third line", "fourth line"]
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize("n", [-1, MAX_BATCH_SIZE + 1])
+def test_batch_size_out_of_bounds_is_rejected(tmp_path, n):
+    pool = make_pool(tmp_path)
+    with pytest.raises(ValueError):
+        asyncio.run(pool.generate(n))
+
+
+def test_batch_sizes_within_bounds(tmp_path):
+    async def run():
+        pool = make_pool(tmp_path)
+        try:
+            assert await pool.generate(0) == []
+            assert len(await pool.generate(MAX_BATCH_SIZE)) == MAX_BATCH_SIZE
+        finally:
+            await pool.stop()
+
+    asyncio.run(run())
+
+
+def test_sentence_pool_refills_to_the_high_watermark():
+    requested = []
+
+    async def generate(n):
+        requested.append(n)
+        return [f"sentence {i}" for i in range(n)]
+
+    async def run():
+        pool = SentencePool(generate, low_watermark=2, high_watermark=8, batch_size=3)
+        pool.start()
+        await asyncio.sleep(0.05)
+        assert pool.queue.qsize() == 8
+        assert requested == [3, 3, 2]
+        for _ in range(6):
+            assert pool.pop()
+        await asyncio.sleep(0.05)
+        assert pool.queue.qsize() == 8
+        await pool.stop()
+
+    asyncio.run(run())
+
+
+def test_sentence_pool_backs_off_on_empty_batches():
+    calls = 0
+
+    async def generate(n):
+        nonlocal calls
+        calls += 1
+        return [""] * n
+
+    async def run():
+        pool = SentencePool(generate, low_watermark=2, high_watermark=8, retry_delay=10)
+        pool.start()
+        await asyncio.sleep(0.1)
+        assert calls == 1
+        assert pool.pop() is None
+        await pool.stop()
+
+    asyncio.run(run())
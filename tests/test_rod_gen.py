@@ -0,0 +1,85 @@
+"""
+Smoke tests of the real rod_gen.exe: compile a tiny corpus into a snapshot, map it back and generate
+from it, also through the serve protocol. Skipped until `dune build` has produced the binary.
+"""
+import asyncio
+import json
+import os
+import subprocess
+
+import pytest
+
+from generator import RodGenPool
+
+ROD_GEN_EXE = os.path.abspath(os.getenv(
+    "ROD_GEN_EXE", os.path.join(os.path.dirname(__file__), "..", "_build", "default", "rod_gen.exe")
+))
+
+pytestmark = pytest.mark.skipif(not os.path.exists(ROD_GEN_EXE), reason="rod_gen.exe is not built, run `dune build`")
+
+CORPUS = [
+    "the cat sat on the mat today",
+    "the dog sat on the log yesterday",
+    "a cat ran after the dog today",
+    "the dog ran after a ball",
+    "my cat likes the warm mat",
+    "your dog likes the big ball",
+]
+VOCABULARY = {word for line in CORPUS for word in line.split()}
+
+
+@pytest.fixture
+def corpus_dir(tmp_path, monkeypatch):
+    """A working directory with text-files/ like the bot's, rod_gen finds its files relative to it."""
+    (tmp_path / "text-files").mkdir()
+    (tmp_path / "text-files" / "all_messages_processed.txt").write_text("\n".join(CORPUS) + "\n", encoding='utf-8')
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def rod_gen(*args) -> str:
+    return subprocess.run([ROD_GEN_EXE, *args], capture_output=True, text=True, check=True, timeout=60).stdout
+
+
+def assert_from_corpus(sentence: str):
+    assert {word.lower() for word in sentence.split()} <= {word.lower() for word in VOCABULARY}, sentence
+
+
+def test_compile_map_and_generate(corpus_dir):
+    rod_gen("--compile")
+    assert (corpus_dir / "text-files" / "rod_model.bin").stat().st_size > 0
+
+    sentences = json.loads(rod_gen("-n", "20", "--seed", "7", "--json"))
+    assert len(sentences) == 20
+    for sentence in sentences:
+        assert_from_corpus(sentence)
+    assert json.loads(rod_gen("-n", "20", "--seed", "7", "--json")) == sentences
+
+
+def test_stats(corpus_dir):
+    output = rod_gen("--stats")
+    assert output.startswith(f"{len(CORPUS)} lines\n")
+    assert "order 1:" in output
+
+
+def test_serve_protocol(corpus_dir):
+    rod_gen("--compile")
+
+    async def run():
+        pool = RodGenPool(1, command=(ROD_GEN_EXE, "--serve"), compile_command=(ROD_GEN_EXE, "--compile"))
+        await pool.start()
+        try:
+            assert_from_corpus(await pool.generate())
+            await pool.learn("the zebra sat on the ball")
+            batch = await pool.generate(10, seed=3)
+            assert len(batch) == 10
+            assert batch == await pool.generate(10, seed=3)
+            await pool.checkpoint()
+            assert pool.learned == []
+            stats = json.loads(await pool.request("stats"))
+            assert stats["sentences"] >= 1
+            assert set(stats) == {"sentences", "attempts", "gave_up", "rejected_verbatim"}
+        finally:
+            await pool.stop()
+
+    asyncio.run(run())
@@ -0,0 +1,53 @@
+import itertools
+
+import pytest
+
+import slot_machine
+from slot_machine import SLOT_EMOJIS, expected_value, resolve_spin, simulate
+
+
+@pytest.fixture
+def pairs_pay(monkeypatch):
+    """resolve_spin paying 1 for any pair, on top of the three of a kind payouts."""
+    original = slot_machine.resolve_spin
+
+    def resolve_with_pairs(reels):
+        payout, message = original(reels)
+        if payout == 0 and len(set(reels)) == 2:
+            return 1, message
+        return payout, message
+
+    monkeypatch.setattr(slot_machine, "resolve_spin", resolve_with_pairs)
+    slot_machine._payout_table.cache_clear()
+    yield
+    slot_machine._payout_table.cache_clear()
+
+
+def test_payout_table_matches_resolve_spin():
+    table = slot_machine._payout_table()
+    for i, j, k in itertools.product(range(len(SLOT_EMOJIS)), repeat=3):
+        assert table[i][j][k] == resolve_spin((SLOT_EMOJIS[i], SLOT_EMOJIS[j], SLOT_EMOJIS[k]))[0]
+
+
+def test_expected_value_follows_resolve_spin(pairs_pay):
+    p = slot_machine._probabilities()
+    not_all_different = sum(p[i] * p[j] * p[k] for i, j, k in itertools.product(range(len(p)), repeat=3)
+                            if len({i, j, k}) < 3)
+    assert expected_value()["hit_frequency"] == pytest.approx(not_all_different)
+
+
+@pytest.mark.parametrize("use_numpy", [False, True])
+def test_simulation_agrees_with_the_exact_value(monkeypatch, pairs_pay, use_numpy):
+    if use_numpy and slot_machine.numpy is None:
+        pytest.skip("NumPy is not installed")
+    if not use_numpy:
+        monkeypatch.setattr(slot_machine, "numpy", None)
+    simulated = simulate(200_000, seed=1)
+    exact = expected_value()
+    assert simulated["hit_frequency"] == pytest.approx(exact["hit_frequency"], abs=0.01)
+
+
+@pytest.mark.parametrize("n_spins", [0, -1])
+def test_simulation_needs_a_spin(n_spins):
+    with pytest.raises(ValueError):
+        simulate(n_spins)
@@ -0,0 +1,53 @@
+import asyncio
+import json
+from concurrent.futures import ProcessPoolExecutor
+
+from leader_lease import LeaderLease
+from state_store import SharedCounter, StateStore
+
+
+def increment_many(path: str, times: int) -> list:
+    counter = SharedCounter(path, "n")
+    return [counter._increment() for _ in range(times)]
+
+
+def test_shared_counter_never_hands_out_a_value_twice(tmp_path):
+    path = str(tmp_path / "counter.json")
+    with ProcessPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(increment_many, [path] * 4, [50] * 4))
+    values = [value for result in results for value in result]
+    assert sorted(values) == list(range(1, 201))
+    assert SharedCounter(path, "n").read() == 200
+
+
+def test_shared_counter_continues_from_its_floor(tmp_path):
+    path = str(tmp_path / "counter.json")
+    assert SharedCounter(path, "n", floor=10).read() == 10
+    assert asyncio.run(SharedCounter(path, "n", floor=10).increment()) == 11
+    assert asyncio.run(SharedCounter(path, "n", floor=3).increment()) == 12
+
+
+def test_state_store_coalesces_updates_into_one_write(tmp_path):
+    path = str(tmp_path / "state.json")
+
+    async def run():
+        store = StateStore(path, flush_delay=0.05)
+        for _ in range(5):
+            store.increment("n")
+        assert store.get("n") == 5
+        await asyncio.sleep(0.2)
+
+    asyncio.run(run())
+    with open(path) as f:
+        assert json.load(f) == {"n": 5}
+    assert StateStore(path).get("n") == 5
+
+
+def test_leader_lease_is_held_by_one_holder_at_a_time(tmp_path):
+    path = str(tmp_path / "leader.lock")
+    first, second = LeaderLease(path), LeaderLease(path)
+    assert first.try_acquire()
+    assert not second.try_acquire()
+    first.release()
+    assert second.try_acquire()
+    second.release()